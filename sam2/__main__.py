@@ -1,6 +1,11 @@
+import sys
 import sam2.configs as configs
 import sam2.core as core
 
+# The daemon commands are thin clients (or the server), they skip the banner and never touch the output paths
+if len(sys.argv) > 1 and sys.argv[1] == "daemon":
+    sys.exit(core.run_task("daemon", sys.argv[2:]))
+
 """
 These system-level output are the inner printing functions, if they are annoying you, it can be disabled by
 change the "TURNED_ON" to False
@@ -22,6 +27,7 @@ class Colors:
     RESET = "39"
 
 def _write2logfile(msg):
+    configs.L.create()
     with open(configs.SYSTEM_OUTPUT_LOGS, "a+") as logfile:
         logfile.write(msg+"\n")
 
@@ -49,3 +55,9 @@ for _name, _path in _paths.items():
     SYS_SPECIAL(f"{_name}: {_path}")
 SYS_SPECIAL("======================= END ========================")
 
+if len(sys.argv) > 1:
+    try:
+        sys.exit(core.run_task(sys.argv[1], sys.argv[2:]))
+    except core.TaskNotExist as e:
+        SYS_ERROR(e.args[0])
+        sys.exit(2)
@@ -1,36 +1,214 @@
 # Here we configure and store all the critical paths/files or settings for our system
 # The path/files are arranged by relative path, while the absolute path is not suggested
 #     here for inflexible reasons.
+import os
+import sys
+import stat
+import time
 import inspect
 from datetime import datetime
-from os.path import join, dirname, abspath, isfile
+from os.path import join, dirname, basename, abspath, normpath
 from os import makedirs
 
 from typing_extensions import LiteralString
 
 class Path:
+    """
+    The file system metadata (stat results and directory listings) is cached and shared by all Path instances, so
+    that the hot code paths do not stat the same paths over and over (expensive on NFS).
+    A cached item is valid for STAT_TTL seconds (None: never expires), and all of them are dropped at once by
+    Path.invalidate(). Path.invalidate(path) only drops the items of that path.
+    The caches hold at most MAX_STATS / MAX_SCANS items, the expired ones are purged when a cache is full.
+    """
     _registered_paths = {}
+
+    STAT_TTL = 2.0
+    MAX_RESOLVED = 4096
+    MAX_STATS = 65536
+    MAX_SCANS = 256
+    _generation = 0
+    _stat_cache = {}  # path -> (generation, time, stat_result or None)
+    _scan_cache = {}  # directory -> (generation, time, entries, names)
+    _stats = {"stat": 0, "scandir": 0, "makedirs": 0, "hit": 0}
+
     def __init__(self, root_path, path_name=None) -> None:
         self._root = root_path
+        self._name = path_name
+        self._resolved = {}
+        self._children = {}
         if path_name is not None:
             self._registered_paths[path_name] = root_path
 
+    def _rebind(self, root_path) -> None:
+        """ Point this (shared) instance to another path, the modules holding it see the change as well """
+        self._root = root_path
+        self._resolved.clear()
+        self._children.clear()
+        if self._name is not None:
+            self._registered_paths[self._name] = root_path
+
     def __call__(self, *add_path_relative: str) -> str:
-        return str(join(self._root, *add_path_relative))
+        p = self._resolved.get(add_path_relative)
+        if p is None:
+            if len(self._resolved) >= self.MAX_RESOLVED: self._resolved.clear()
+            p = self._resolved[add_path_relative] = str(join(self._root, *add_path_relative))
+        return p
 
     def __str__(self) -> str: return self._root
 
     def value(self) -> str: return self._root
 
-    def __add__(self, other) -> "Path": return Path(join(self._root, str(other)))
+    def __add__(self, other) -> "Path":
+        other = str(other)
+        p = self._children.get(other)
+        if p is None:
+            if len(self._children) >= self.MAX_RESOLVED: self._children.clear()
+            p = self._children[other] = Path(join(self._root, other))
+        return p
+
+    """
+    File system metadata cache
+    """
+
+    @classmethod
+    def _valid(cls, item) -> bool:
+        return item[0] == cls._generation and (cls.STAT_TTL is None or time.monotonic() - item[1] < cls.STAT_TTL)
+
+    @classmethod
+    def _put(cls, cache: dict, limit: int, key, item) -> None:
+        if len(cache) >= limit:
+            for k in [k for k, v in cache.items() if not cls._valid(v)]:
+                del cache[k]
+            if len(cache) >= limit:
+                cache.clear()
+        cache[key] = item
+
+    @classmethod
+    def stat_of(cls, path: str, refresh=False):
+        """ :return: The (cached) os.stat result of path, or None if it does not exist """
+        path = str(path)
+        # the cache is keyed by the normalized paths, "dir/" is "dir" (not the entry "" in the listing of "dir")
+        key = normpath(path)
+        item = cls._stat_cache.get(key)
+        if item is not None and not refresh and cls._valid(item):
+            cls._stats["hit"] += 1
+            return item[2]
+        # a valid listing of the parent directory tells whether the path exists
+        parent = cls._scan_cache.get(dirname(key))
+        if parent is not None and not refresh and cls._valid(parent):
+            cls._stats["hit"] += 1
+            entry = parent[3].get(basename(key))
+            if entry is None:
+                return None
+            try:
+                return entry.stat()
+            except OSError:
+                return None
+        cls._stats["stat"] += 1
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            st = None
+        cls._put(cls._stat_cache, cls.MAX_STATS, key, (cls._generation, time.monotonic(), st))
+        return st
+
+    def stat(self, refresh=False): return self.stat_of(self._root, refresh=refresh)
+
+    def exists(self, refresh=False) -> bool: return self.stat(refresh=refresh) is not None
 
     @property
-    def isfile(self): return isfile(self._root)
+    def isfile(self):
+        st = self.stat()
+        return st is not None and stat.S_ISREG(st.st_mode)
+
+    @property
+    def isdir(self):
+        st = self.stat()
+        return st is not None and stat.S_ISDIR(st.st_mode)
 
     def create(self, exist_ok=True) -> "Path":
-        if not isfile(self._root): makedirs(self._root, exist_ok=exist_ok)
+        """ Create the directory (and its parents), nothing is done if the path is an existing file """
+        # never answered by the cache: the directory may have been removed since it was cached
+        self._makedirs(self._root, exist_ok=exist_ok)
         return self
 
+    @classmethod
+    def _makedirs(cls, path, exist_ok=True):
+        cls._stats["makedirs"] += 1
+        try:
+            os.mkdir(path)
+        except FileNotFoundError:
+            makedirs(path, exist_ok=exist_ok)
+        except FileExistsError:
+            if not os.path.isdir(path):
+                if os.path.isfile(path):
+                    return
+                raise
+            if not exist_ok:
+                raise
+            # nothing is changed, only a stale "missing" item of the path is dropped
+            item = cls._stat_cache.get(normpath(path))
+            if item is not None and item[2] is None: cls._stat_cache.pop(normpath(path))
+            return
+        cls.invalidate(path)
+        # the missing parents are created as well
+        parent = dirname(normpath(path))
+        while parent and parent != dirname(parent):
+            cls._scan_cache.pop(dirname(parent), None)
+            item = cls._stat_cache.get(parent)
+            if item is not None and item[2] is None: cls._stat_cache.pop(parent)
+            parent = dirname(parent)
+
+    @classmethod
+    def create_many(cls, paths) -> None:
+        """ Create directories in batch, the parents of the deeper ones are created with them and are skipped """
+        todo = sorted({str(p) for p in paths}, key=len, reverse=True)
+        created = []
+        for p in todo:
+            if any(c.startswith(p + os.sep) for c in created):
+                continue
+            cls._makedirs(p)
+            created.append(p)
+
+    def scan(self, suffixes=None, refresh=False) -> list:
+        """
+        :param suffixes: Only the entries whose names end with one of them (case-insensitive) are returned
+        :return: The os.DirEntry items of this directory, whose stat results are cached by themselves
+        """
+        key = normpath(self._root)
+        item = self._scan_cache.get(key)
+        if item is None or refresh or not self._valid(item):
+            self._stats["scandir"] += 1
+            with os.scandir(self._root) as it:
+                entries = list(it)
+            item = (self._generation, time.monotonic(), entries, {e.name: e for e in entries})
+            self._put(self._scan_cache, self.MAX_SCANS, key, item)
+        else:
+            self._stats["hit"] += 1
+        if suffixes is None:
+            return item[2]
+        return [e for e in item[2] if e.name.lower().endswith(suffixes)]
+
+    @classmethod
+    def invalidate(cls, path=None) -> None:
+        if path is None:
+            cls._generation += 1
+            cls._stat_cache.clear()
+            cls._scan_cache.clear()
+            return
+        path = normpath(str(path))
+        cls._stat_cache.pop(path, None)
+        cls._scan_cache.pop(path, None)
+        cls._scan_cache.pop(dirname(path), None)
+
+    @classmethod
+    def syscall_stats(cls, reset=False) -> dict:
+        """ :return: Number of the metadata system calls done and saved (hit) by the cache """
+        stats = dict(cls._stats)
+        if reset:
+            for k in cls._stats: cls._stats[k] = 0
+        return stats
+
     @classmethod
     def get_registered_paths(cls) -> dict[str, "Path"]: return cls._registered_paths
 
@@ -44,15 +222,31 @@ ConfigPath = join(SAM_ROOT, "configs"); C = Path(ConfigPath, "ConfigPath")
 ModulePath = join(SAM_ROOT, "modules"); M = Path(ModulePath, "ModulePath")
 TaskPath = join(SAM_ROOT, "tasks"); T = Path(TaskPath, "TaskPath")
 
-# Extra output paths
+# Extra output paths, they are created when they are used for the first time (e.g. L.create() by sam2.logging)
 OutputPath = R("outputs", get_timestamp_now()); O = Path(OutputPath, "OutputPath")
-LogsPath = O("logs"); L = Path(LogsPath, "LogsPath").create()
+LogsPath = O("logs"); L = Path(LogsPath, "LogsPath")
 
 # Real path constructed below:
 LOGGER_CONFIG_FILE = C("logger.json")
 SYSTEM_OUTPUT_LOGS = L("system-output-logs.log")
 
+def set_output_path(output_path=None) -> Path:
+    """
+    Move the outputs of this process to a new directory (a new timestamp by default), e.g. one for each job run by
+    a daemon worker. O and L are changed in place, so the modules which have imported them use the new paths too,
+    and the log files already opened by sam2.logging are moved to the new logs directory.
+    """
+    global OutputPath, LogsPath, SYSTEM_OUTPUT_LOGS
+    OutputPath = R("outputs", get_timestamp_now()) if output_path is None else str(output_path)
+    O._rebind(OutputPath)
+    LogsPath = O("logs"); L._rebind(LogsPath)
+    SYSTEM_OUTPUT_LOGS = L("system-output-logs.log")
+    if "sam2.logging" in sys.modules:
+        sys.modules["sam2.logging"].GLogger.set_logs_dir(LogsPath)
+    return O
+
 # Shared Space path
 SharedSpacePath = R(".shared_space"); S = Path(SharedSpacePath, "SharedSpacePath")
 SequenceCachePath = S("sequences"); Q = Path(SequenceCachePath, "SequenceCachePath").create()
-
+PreprocessCachePath = S("preprocessed"); P = Path(PreprocessCachePath, "PreprocessCachePath")
+MemoryBankPath = S("memory_bank"); B = Path(MemoryBankPath, "MemoryBankPath")
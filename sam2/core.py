@@ -1,5 +1,51 @@
+import argparse
+import importlib
 
+"""
+All tasks which can be run from the terminal are registered here by their names:
+    python -m sam2 <task name> [task arguments ...]
 
+A task is a class with a main() method, it is created with the parsed arguments as keyword arguments. The
+arguments are declared by an optional classmethod add_arguments(parser).
+"""
 
+# "tracking" (sam2.tasks.tracking:Tracking) is registered once its module can be imported
+TASKS = {
+    "bench": "sam2.tasks.bench:Bench",
+    "daemon": "sam2.daemon:DaemonTask",
+}
 
 
+class TaskNotExist(KeyError): pass
+
+
+_RESOURCES = {}
+
+
+def resource(key, factory):
+    """
+    Get an object kept for the lifetime of the process (e.g. caches, preprocessors), it is created by factory()
+    at the first call. In daemon mode, the objects are shared by all the jobs run by the same warm worker.
+    """
+    obj = _RESOURCES.get(key)
+    if obj is None:
+        obj = _RESOURCES[key] = factory()
+    return obj
+
+
+def get_task(name: str):
+    entry = TASKS.get(name)
+    if entry is None:
+        raise TaskNotExist(f"Unknown task <{name}>, available tasks: {', '.join(sorted(TASKS))}")
+    module_name, cls_name = entry.split(':')
+    return getattr(importlib.import_module(module_name), cls_name)
+
+
+def run_task(name: str, argv=()) -> int:
+    cls = get_task(name)
+    parser = argparse.ArgumentParser(prog=f"sam2 {name}")
+    if hasattr(cls, "add_arguments"):
+        cls.add_arguments(parser)
+    args = parser.parse_args(list(argv))
+    ret = cls(**vars(args)).main()
+    return ret if isinstance(ret, int) else 0
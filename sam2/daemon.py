@@ -0,0 +1,440 @@
+"""
+Daemon mode: a long-lived server on a local unix socket keeps warm worker processes (modules imported, configs
+parsed, caches and the datapool alive), and the thin cli invocations only submit tasks to it:
+
+    python -m sam2 daemon start [--workers 2] [--max-queue 16]    # in foreground
+    python -m sam2 daemon run <task> [task arguments ...]         # e.g. python -m sam2 daemon run bench --quick
+    python -m sam2 daemon status
+    python -m sam2 daemon stop
+
+The protocol is newline-delimited json. A request is one of
+    {"op": "submit", "task": <name>, "argv": [...]}, {"op": "status"}, {"op": "shutdown"}
+and the server answers a submit with a stream of events of the job, the last one is "done":
+    {"event": "queued", "job": <id>, "position": <n>}
+    {"event": "started", "job": <id>, "worker": <index>}
+    {"event": "output", "job": <id>, "stream": "stdout" | "stderr", "data": <text>}
+    {"event": "done", "job": <id>, "worker": <index>, "code": <exit code>, "elapsed": <seconds>}
+    {"event": "error", "message": <text>}    (the request is rejected, e.g. the queue is full)
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import tempfile
+import importlib
+import threading
+import traceback
+from collections import deque
+import multiprocessing as mp
+from typing import Dict, Iterator
+
+import sam2.configs as configs
+from sam2.configs import R, S
+import sam2.core as core
+
+DEFAULT_SOCKET = S("daemon.sock")
+# the length of a unix socket path is limited (108 bytes on linux)
+if len(DEFAULT_SOCKET.encode()) > 100:
+    DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), f"sam2-daemon-{os.getuid()}.sock")
+
+PRELOAD_MODULES = ("numpy", "cv2", "sam2.utils.io", "sam2.utils.storage")
+
+CODE_BUSY = 75
+CODE_KILLED = -9
+
+WORKER_CHECK_INTERVAL = 0.2
+JOB_CHECK_INTERVAL = 1.0
+
+
+class DaemonError(Exception): pass
+class DaemonNotRunning(DaemonError): pass
+class DaemonRunning(DaemonError): pass
+
+
+def _send(conn: socket.socket, msg: Dict) -> None:
+    conn.sendall((json.dumps(msg) + "\n").encode("utf-8"))
+
+
+def _receive(conn: socket.socket) -> Iterator[Dict]:
+    with conn.makefile("r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+"""
+Worker
+"""
+
+class _EventWriter(object):
+    """ Replaces stdout/stderr in a worker, the text written by the tasks is streamed back to the client """
+    def __init__(self, events, job_id, stream):
+        self._events, self._job_id, self._stream = events, job_id, stream
+
+    def write(self, data):
+        if data:
+            self._events.put({"event": "output", "job": self._job_id, "stream": self._stream, "data": data})
+        return len(data)
+
+    def flush(self): pass
+
+    def isatty(self): return False
+
+
+def _worker_main(index, jobs, events, server_pid):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # the handler inherited from the server only stops the forked copy of the server, terminate() must kill
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if "sam2.utils.storage" in sys.modules:
+        from sam2.utils.storage import datapool_threading
+        datapool_threading()
+    stdout, stderr = sys.stdout, sys.stderr
+    while True:
+        try:
+            job = jobs.get(timeout=1)
+        except queue.Empty:
+            # the workers are not daemonic (the tasks may start their own processes), so they quit by themselves
+            # once the server is gone
+            if os.getppid() != server_pid:
+                break
+            continue
+        if job is None:
+            break
+        job_id, task, argv = job
+        # each job has its own output directory, so the stores under OutputPath are never shared by the jobs
+        configs.set_output_path(R("outputs", f"{configs.get_timestamp_now()}_job{job_id}"))
+        events.put({"event": "started", "job": job_id, "worker": index})
+        t = time.perf_counter()
+        sys.stdout = _EventWriter(events, job_id, "stdout")
+        sys.stderr = _EventWriter(events, job_id, "stderr")
+        try:
+            code = core.run_task(task, argv)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            if not isinstance(e.code, (int, type(None))):
+                print(e.code, file=sys.stderr)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        events.put({"event": "done", "job": job_id, "worker": index, "code": code, "elapsed": time.perf_counter() - t})
+
+
+"""
+Server
+"""
+
+class Daemon(object):
+    def __init__(self, socket_path=DEFAULT_SOCKET, workers=2, max_queue=16) -> None:
+        """
+        :param workers: Number of worker processes, that is the number of jobs running at the same time
+        :param max_queue: Number of jobs allowed to wait for a worker, the others are rejected
+        """
+        self.socket_path = socket_path
+        self.num_workers = int(workers)
+        self.max_queue = int(max_queue)
+        self._ctx = mp.get_context("fork")
+        self._events = self._ctx.Queue()
+        # each worker has its own job queue, so the server always knows which job a worker is running
+        self._workers = []
+        self._worker_jobs = []
+        self._worker_job: Dict[int, int] = {}
+        self._idle = set()
+        self._queue = deque()
+        self._job_events: Dict[int, queue.Queue] = {}
+        self._lock = threading.Lock()
+        self._next_job = 0
+        self._completed = 0
+        self._start_time = time.time()
+        self._stopped = threading.Event()
+        self._server = None
+
+    @staticmethod
+    def preload():
+        for module_name in PRELOAD_MODULES + tuple(v.split(':')[0] for v in core.TASKS.values()):
+            try:
+                importlib.import_module(module_name)
+            except Exception as e:
+                print(f"[daemon] preload of {module_name} is skipped. (reason: {type(e).__name__}: {e})")
+
+    def _spawn_worker(self, index):
+        jobs = self._ctx.Queue()
+        p = self._ctx.Process(target=_worker_main, args=(index, jobs, self._events, os.getpid()))
+        p.start()
+        if index < len(self._workers):
+            self._workers[index], self._worker_jobs[index] = p, jobs
+        else:
+            self._workers.append(p)
+            self._worker_jobs.append(jobs)
+        self._idle.add(index)
+
+    def _bind(self):
+        if os.path.exists(self.socket_path):
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                    s.connect(self.socket_path)
+                raise DaemonRunning(self.socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(self.socket_path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.socket_path)
+        self._server.listen(64)
+
+    def serve_forever(self):
+        self._bind()
+        self.preload()
+        with self._lock:
+            for i in range(self.num_workers):
+                self._spawn_worker(i)
+        threading.Thread(target=self._route_events, daemon=True).start()
+        print(f"[daemon] pid {os.getpid()} listening on {self.socket_path} with {self.num_workers} workers", flush=True)
+        self._server.settimeout(0.5)
+        try:
+            while not self._stopped.is_set():
+                try:
+                    conn, _ = self._server.accept()
+                except socket.timeout:
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self._shutdown()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _shutdown(self):
+        self._server.close()
+        try:
+            os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+        for jobs in self._worker_jobs:
+            jobs.put(None)
+        for p in self._workers:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+                p.join(timeout=5)
+            if p.is_alive():
+                p.kill()
+                p.join()
+        if "sam2.utils.storage" in sys.modules:
+            sys.modules["sam2.utils.storage"].close_pool()
+        print("[daemon] stopped", flush=True)
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "uptime": time.time() - self._start_time,
+                "workers": self.num_workers,
+                "alive_workers": sum(p.is_alive() for p in self._workers),
+                "running": len(self._worker_job),
+                "queued": len(self._queue),
+                "completed": self._completed,
+                "max_queue": self.max_queue,
+            }
+
+    def _dispatch(self):
+        """ Give the queued jobs to the idle workers, called with the lock held """
+        while self._queue and self._idle:
+            index = self._idle.pop()
+            job = self._queue.popleft()
+            self._worker_job[index] = job[0]
+            self._worker_jobs[index].put(job)
+
+    def _finish(self, job_id, event):
+        """ Deliver the last event of a job, called with the lock held """
+        self._completed += 1
+        q = self._job_events.get(job_id)
+        if q is not None:
+            q.put(event)
+
+    def _route_events(self):
+        last_check = 0.0
+        while True:
+            try:
+                event = self._events.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                event = None
+            if event is not None:
+                job_id = event["job"]
+                with self._lock:
+                    if event["event"] == "done":
+                        # a late event of a job already failed with its dead worker is dropped
+                        if self._worker_job.get(event["worker"]) == job_id:
+                            self._worker_job.pop(event["worker"])
+                            self._idle.add(event["worker"])
+                            self._finish(job_id, event)
+                            self._dispatch()
+                    else:
+                        q = self._job_events.get(job_id)
+                        if q is not None:
+                            q.put(event)
+            # checked on every loop, even if other workers keep streaming events
+            if time.monotonic() - last_check >= WORKER_CHECK_INTERVAL:
+                last_check = time.monotonic()
+                self._check_workers()
+
+    def _check_workers(self):
+        # a crashed worker fails the job assigned to it, and is replaced by a new one
+        if self._stopped.is_set():
+            return
+        with self._lock:
+            for i, p in enumerate(self._workers):
+                if p.is_alive():
+                    continue
+                print(f"[daemon] worker {i} died (exit code {p.exitcode}), restarting", flush=True)
+                job_id = self._worker_job.pop(i, None)
+                self._spawn_worker(i)
+                if job_id is not None:
+                    self._finish(job_id, {"event": "done", "job": job_id, "worker": i, "code": CODE_KILLED,
+                                          "elapsed": 0.0})
+            self._dispatch()
+
+    def _is_alive_job(self, job_id) -> bool:
+        with self._lock:
+            return job_id in self._worker_job.values() or any(job[0] == job_id for job in self._queue)
+
+    def _handle(self, conn: socket.socket):
+        with conn:
+            try:
+                request = next(_receive(conn), None)
+                if request is None:
+                    return
+                op = request.get("op")
+                if op == "status":
+                    _send(conn, {"event": "status", **self.status()})
+                elif op == "shutdown":
+                    _send(conn, {"event": "status", **self.status()})
+                    self.stop()
+                elif op == "submit":
+                    self._submit(conn, request)
+                else:
+                    _send(conn, {"event": "error", "message": f"Unknown op <{op}>"})
+            except (BrokenPipeError, ConnectionResetError, json.JSONDecodeError):
+                pass
+
+    def _submit(self, conn: socket.socket, request: Dict):
+        task, argv = request.get("task"), list(request.get("argv", []))
+        if task not in core.TASKS or task == "daemon":
+            _send(conn, {"event": "error", "message": f"Unknown task <{task}>"})
+            return
+        with self._lock:
+            pending = len(self._queue) + len(self._worker_job)
+            if pending >= self.num_workers + self.max_queue:
+                _send(conn, {"event": "error", "code": CODE_BUSY,
+                             "message": f"Daemon is busy ({pending} jobs pending)"})
+                return
+            job_id = self._next_job
+            self._next_job += 1
+            position = len(self._queue) if not self._idle else 0
+            events = self._job_events[job_id] = queue.Queue()
+            self._queue.append((job_id, task, argv))
+            self._dispatch()
+        connected = True
+        try:
+            _send(conn, {"event": "queued", "job": job_id, "position": position})
+        except OSError:
+            connected = False
+        while True:
+            try:
+                event = events.get(timeout=JOB_CHECK_INTERVAL)
+            except queue.Empty:
+                # never wait for a job that is neither queued nor running any more
+                if self._is_alive_job(job_id) or not events.empty():
+                    continue
+                event = {"event": "done", "job": job_id, "code": CODE_KILLED, "elapsed": 0.0}
+            if connected:
+                try:
+                    _send(conn, event)
+                except OSError:
+                    # the client has gone, the job is finished anyway
+                    connected = False
+            if event["event"] == "done":
+                break
+        with self._lock:
+            self._job_events.pop(job_id, None)
+
+
+"""
+Client
+"""
+
+def _connect(socket_path=DEFAULT_SOCKET) -> socket.socket:
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        raise DaemonNotRunning(f"No daemon is listening on {socket_path}, start it with: python -m sam2 daemon start")
+    return conn
+
+
+def request(msg: Dict, socket_path=DEFAULT_SOCKET) -> Iterator[Dict]:
+    with _connect(socket_path) as conn:
+        _send(conn, msg)
+        yield from _receive(conn)
+
+
+def submit(task: str, argv=(), socket_path=DEFAULT_SOCKET, out=sys.stdout, err=sys.stderr) -> int:
+    """ Run a task in the daemon, the output of the task is streamed to out/err, and its exit code is returned """
+    for event in request({"op": "submit", "task": task, "argv": list(argv)}, socket_path):
+        kind = event["event"]
+        if kind == "output":
+            stream = out if event["stream"] == "stdout" else err
+            stream.write(event["data"])
+            stream.flush()
+        elif kind == "done":
+            return event["code"]
+        elif kind == "error":
+            err.write(f"[daemon] {event['message']}\n")
+            return event.get("code", 1)
+    err.write("[daemon] connection closed before the job is done\n")
+    return 1
+
+
+class DaemonTask(object):
+    """ The cli entrance: python -m sam2 daemon {start,run,status,stop} """
+
+    def __init__(self, command, socket=DEFAULT_SOCKET, workers=2, max_queue=16, task=None, argv=()):
+        self._command = command
+        self._socket = socket
+        self._workers, self._max_queue = workers, max_queue
+        self._task, self._argv = task, argv
+
+    @classmethod
+    def add_arguments(cls, parser):
+        parser.add_argument("--socket", default=DEFAULT_SOCKET, help="The unix socket of the daemon")
+        sub = parser.add_subparsers(dest="command", required=True)
+        start = sub.add_parser("start", help="Start the daemon in foreground")
+        start.add_argument("--workers", type=int, default=2, help="Number of warm worker processes")
+        start.add_argument("--max-queue", type=int, default=16, help="Number of jobs allowed to wait")
+        run = sub.add_parser("run", help="Run a task in the daemon")
+        run.add_argument("task", choices=sorted(k for k in core.TASKS if k != "daemon"))
+        run.add_argument("argv", nargs="...")
+        sub.add_parser("status", help="Show the state of the daemon")
+        sub.add_parser("stop", help="Stop the daemon")
+
+    def main(self):
+        try:
+            if self._command == "start":
+                daemon = Daemon(self._socket, workers=self._workers, max_queue=self._max_queue)
+                signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+                signal.signal(signal.SIGINT, lambda *_: daemon.stop())
+                daemon.serve_forever()
+                return 0
+            if self._command == "run":
+                return submit(self._task, self._argv, self._socket)
+            for event in request({"op": "shutdown" if self._command == "stop" else "status"}, self._socket):
+                event.pop("event", None)
+                print(json.dumps(event, indent=2))
+            return 0
+        except DaemonError as e:
+            print(f"[daemon] {type(e).__name__}: {e}", file=sys.stderr)
+            return 1
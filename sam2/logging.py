@@ -2,7 +2,7 @@ import os
 import logging, coloredlogs
 import json
 from collections import OrderedDict
-from sam2.configs import LOGGER_CONFIG_FILE, LogsPath
+from sam2.configs import LOGGER_CONFIG_FILE, LogsPath, L
 
 '''
 通过这个脚本中的内容我们可以实现在任何一个地方对整个系统的日志进行统一的输出
@@ -89,6 +89,21 @@ class LoggerManager(object):
             return True, file_name, fh
         return False, file_name, fh
 
+    def set_logs_dir(self, logs_dir):
+        """ Move all the log files to logs_dir (e.g. a new output directory), the old files are closed as they are """
+        self.LOGS_DIR = str(logs_dir)
+        os.makedirs(self.LOGS_DIR, exist_ok=True)
+        for file_name, fh in self.__all_files.items():
+            fh.acquire()
+            try:
+                if fh.stream is not None:
+                    fh.flush()
+                    fh.stream.close()
+                fh.baseFilename = os.path.abspath(os.path.join(self.LOGS_DIR, file_name))
+                fh.stream = fh._open()
+            finally:
+                fh.release()
+
     def get(self, name, cls_name) -> logging.Logger:
         # 如果logger已经存在，则直接返回共享即可
         t = self.__all_loggers.get(name)
@@ -123,6 +138,7 @@ class LoggerManager(object):
         return _L
 
 
+L.create()
 GLogger = LoggerManager(LOGGER_CONFIG_FILE)
 
 if GLogger.ALLOW_ABSTRACT:
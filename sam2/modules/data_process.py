@@ -0,0 +1,265 @@
+"""
+Pre-processing of the input frames for SAM2-style models.
+
+A frame goes through:  resize (model resolution) -> uint8 to float + mean/std normalization -> HWC to CHW
+The last two steps are folded into one multiply and one add per channel (both written in place into the output
+buffer), done once for the whole batch rather than per frame. Everything is written into buffers that are
+allocated once by FramePreprocessor and reused for every batch, so that no per-frame arrays are created.
+
+The optional PreprocessCache stores the pre-processed tensors as .npy files (read back with mmap), keyed by the
+frame identity and the pre-processing parameters, so that repeated experiments on the same sequence could skip
+the whole pre-processing step.
+"""
+
+import os
+import hashlib
+import logging as log
+from typing import Iterable, Iterator, List, Tuple
+
+import cv2
+import numpy as np
+
+from sam2.configs import P, Path
+
+IMAGE_SIZE = 1024
+IMAGE_MEAN = (0.485, 0.456, 0.406)
+IMAGE_STD = (0.229, 0.224, 0.225)
+
+
+class PreprocessConfig(object):
+    def __init__(self, image_size=IMAGE_SIZE, mean=IMAGE_MEAN, std=IMAGE_STD,
+                 dtype=np.float32, bgr=True, interpolation=cv2.INTER_LINEAR) -> None:
+        """
+        :param image_size: The (square) input resolution of the model
+        :param mean: Per-channel mean in RGB order, based on [0, 1] pixel values
+        :param std: Per-channel std in RGB order, based on [0, 1] pixel values
+        :param dtype: The output dtype (float32 or float16)
+        :param bgr: If true, the input frames are in BGR order (as read by opencv), and are flipped to RGB
+        :param interpolation: The opencv interpolation flag used for resizing
+        """
+        self.image_size = int(image_size)
+        self.mean = tuple(float(m) for m in mean)
+        self.std = tuple(float(s) for s in std)
+        self.dtype = np.dtype(dtype)
+        self.bgr = bool(bgr)
+        self.interpolation = int(interpolation)
+
+        # x_norm = (x / 255 - mean) / std = x * scale + offset
+        std_arr = np.asarray(self.std, dtype=np.float64)
+        self.scale = (1.0 / (255.0 * std_arr)).astype(self.dtype).reshape(3, 1, 1)
+        self.offset = (-np.asarray(self.mean, dtype=np.float64) / std_arr).astype(self.dtype).reshape(3, 1, 1)
+
+    def key(self) -> str:
+        """ The identity of the parameters, which is a part of the cache key """
+        return (f"{self.image_size};{','.join(map(repr, self.mean))};{','.join(map(repr, self.std))};"
+                f"{self.dtype.str};{int(self.bgr)};{self.interpolation}")
+
+
+def frame_identity(file_name: str) -> str:
+    """ The identity of an image file, changed once the file is modified """
+    st = os.stat(file_name)
+    return f"{os.path.abspath(file_name)};{st.st_size};{st.st_mtime_ns}"
+
+
+_NO_ID = object()
+
+
+class FramePreprocessor(object):
+    def __init__(self, config: PreprocessConfig = None, batch_size=8) -> None:
+        self.config = PreprocessConfig() if config is None else config
+        self.batch_size = int(batch_size)
+        s = self.config.image_size
+
+        # all buffers are allocated once here
+        self._resized = np.empty((self.batch_size, s, s, 3), dtype=np.uint8)
+        self._resized_gray = np.empty((s, s), dtype=np.uint8)
+        self._out = np.empty((self.batch_size, 3, s, s), dtype=self.config.dtype)
+        self._sizes = np.zeros((self.batch_size, 2), dtype=np.int64)
+
+    @property
+    def Buffer(self) -> np.ndarray:
+        return self._out
+
+    def _resize(self, i, frame: np.ndarray) -> np.ndarray:
+        s = self.config.image_size
+        if frame.ndim == 2 or (frame.ndim == 3 and frame.shape[2] == 1):
+            cv2.resize(frame.reshape(frame.shape[:2]), (s, s), dst=self._resized_gray,
+                       interpolation=self.config.interpolation)
+            np.copyto(self._resized[i], self._resized_gray[..., None])
+        elif frame.ndim == 3 and frame.shape[2] in (3, 4):
+            if frame.shape[2] == 4: frame = frame[..., :3]
+            if frame.shape[:2] == (s, s):
+                np.copyto(self._resized[i], frame)
+            else:
+                cv2.resize(frame, (s, s), dst=self._resized[i], interpolation=self.config.interpolation)
+        else:
+            raise ValueError(f'Unsupported frame shape {frame.shape}!')
+        return self._resized[i]
+
+    def _normalize(self, start, stop):
+        """ Normalize the resized frames of the slots [start, stop) at once """
+        resized = self._resized[start:stop]
+        if self.config.bgr: resized = resized[..., ::-1]
+        # NHWC -> NCHW is only a view, the copy is done by the multiply below
+        out = self._out[start:stop]
+        np.multiply(resized.transpose(0, 3, 1, 2), self.config.scale, out=out, casting='unsafe')
+        np.add(out, self.config.offset, out=out)
+
+    def _prepare(self, i, frame: np.ndarray) -> None:
+        if frame.dtype != np.uint8:
+            raise TypeError(f'Only uint8 frames are supported, got {frame.dtype}!')
+        self._sizes[i] = frame.shape[:2]
+        self._resize(i, frame)
+
+    def process_one(self, i, frame: np.ndarray) -> np.ndarray:
+        """ Pre-process a single frame into the i-th slot of the output buffer """
+        self._prepare(i, frame)
+        self._normalize(i, i + 1)
+        return self._out[i]
+
+    def process(self, frames: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param frames: No more than batch_size uint8 frames (HW, HWC), they can have different sizes
+        :return: (batch, sizes), batch is a (n, 3, S, S) view of the reused output buffer, and sizes is a (n, 2)
+                 view of the original (height, width) of the frames.
+                 Both of them are overwritten by the next call, copy them if they need to be kept.
+        """
+        n = len(frames)
+        if n > self.batch_size:
+            raise ValueError(f'Too many frames ({n}) for batch size {self.batch_size}!')
+        for i, frame in enumerate(frames):
+            self._prepare(i, frame)
+        self._normalize(0, n)
+        return self._out[:n], self._sizes[:n]
+
+    def process_sequence(self, frames: Iterable, ids: Iterable[str] = None,
+                         cache: "PreprocessCache" = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        :param frames: Frames (uint8 arrays) or image files
+        :param ids: The identities of the frames for caching. If None, the identities are generated from the
+                    image files (with frame_identity), and frames given as arrays are never cached.
+        :param cache: A PreprocessCache, optional
+        :return: A generator of (batch, sizes), see process()
+        """
+        frames = iter(frames)
+        ids = iter(ids) if ids is not None else None
+        while True:
+            n = 0
+            # the cache misses are normalized together, by runs of consecutive slots (the hits are in between)
+            misses, run_start = [], None
+            for n_, frame in zip(range(self.batch_size), frames):
+                fid = next(ids, _NO_ID) if ids is not None else None
+                if fid is _NO_ID:
+                    raise ValueError('Fewer ids than frames are given!')
+                if fid is None and isinstance(frame, (str, Path)):
+                    fid = frame_identity(str(frame)) if cache is not None else None
+                n = n_ + 1
+                if cache is not None and fid is not None and cache.load(fid, self.config,
+                                                                        out=self._out[n_], size_out=self._sizes[n_]):
+                    if run_start is not None:
+                        self._normalize(run_start, n_)
+                        run_start = None
+                    continue
+                if isinstance(frame, (str, Path)):
+                    frame = read_frame(str(frame))
+                self._prepare(n_, frame)
+                misses.append((n_, fid))
+                if run_start is None:
+                    run_start = n_
+            if run_start is not None:
+                self._normalize(run_start, n)
+            if cache is not None:
+                for i, fid in misses:
+                    if fid is not None:
+                        cache.save(fid, self.config, self._out[i], self._sizes[i])
+            if n == 0:
+                return
+            yield self._out[:n], self._sizes[:n]
+            if n < self.batch_size:
+                return
+
+
+def read_frame(file_name: str) -> np.ndarray:
+    frame = cv2.imread(file_name, cv2.IMREAD_UNCHANGED)
+    if frame is None:
+        raise FileNotFoundError(f'Cannot read image {file_name}!')
+    if frame.dtype != np.uint8:
+        frame = cv2.convertScaleAbs(frame, alpha=255.0 / max(float(frame.max()), 1.0))
+    return frame
+
+
+class PreprocessCache(object):
+    """
+    Each cached frame is stored as "<md5 of frame identity and config>-<height>x<width>.npy" in the cache
+    directory. The directory is only listed once when the cache is opened, so looking up a frame is just a
+    dict query, no file system call is needed for a miss.
+    """
+    def __init__(self, cache_dir: [str, Path] = P, mmap=True) -> None:
+        self._dir = Path(str(cache_dir)).create()
+        self._mmap = mmap
+        self._index = {}
+        with os.scandir(str(self._dir)) as it:
+            for entry in it:
+                name, ext = os.path.splitext(entry.name)
+                if ext != '.npy' or '-' not in name:
+                    continue
+                code, size = name.split('-', 1)
+                try:
+                    h, w = map(int, size.split('x'))
+                except ValueError:
+                    continue
+                self._index[code] = (entry.name, h, w)
+        log.debug('Preprocess cache %s opened with %d frames.' % (self._dir, len(self._index)))
+
+    @staticmethod
+    def code(frame_id: str, config: PreprocessConfig) -> str:
+        return hashlib.md5(f"{frame_id}|{config.key()}".encode("utf-8")).hexdigest()
+
+    def __len__(self): return len(self._index)
+
+    def __contains__(self, code: str): return code in self._index
+
+    def get(self, frame_id: str, config: PreprocessConfig):
+        """ :return: (tensor, (height, width)), tensor is read-only memory-mapped if mmap is on, or None """
+        item = self._index.get(self.code(frame_id, config))
+        if item is None:
+            return None
+        file_name, h, w = item
+        try:
+            data = np.load(self._dir(file_name), mmap_mode='r' if self._mmap else None)
+        except (FileNotFoundError, ValueError) as e:
+            log.warning('Broken cache file %s is ignored. (reason: %s)' % (file_name, e))
+            self._index.pop(self.code(frame_id, config), None)
+            return None
+        return data, (h, w)
+
+    def load(self, frame_id: str, config: PreprocessConfig, out: np.ndarray, size_out: np.ndarray = None) -> bool:
+        """ Copy the cached tensor into out, return False on a cache miss """
+        item = self.get(frame_id, config)
+        if item is None:
+            return False
+        data, size = item
+        if data.shape != out.shape:
+            return False
+        np.copyto(out, data, casting='unsafe')
+        if size_out is not None:
+            size_out[:] = size
+        return True
+
+    def save(self, frame_id: str, config: PreprocessConfig, tensor: np.ndarray, size) -> None:
+        code = self.code(frame_id, config)
+        h, w = map(int, size)
+        file_name = f"{code}-{h}x{w}.npy"
+        tmp_file = self._dir(f".{file_name}.{os.getpid()}.tmp")
+        with open(tmp_file, 'wb') as f:
+            np.save(f, tensor, allow_pickle=False)
+        os.replace(tmp_file, self._dir(file_name))
+        self._index[code] = (file_name, h, w)
+
+    def clear(self) -> None:
+        for file_name, _, _ in self._index.values():
+            try:
+                os.remove(self._dir(file_name))
+            except FileNotFoundError:
+                pass
+        self._index.clear()
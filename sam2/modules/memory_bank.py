@@ -0,0 +1,305 @@
+"""
+Bounded memory bank for the tracking state of SAM2-style video tracking.
+
+For each object, the per-frame memories (mask memory features, their positional encodings and the object
+pointer) are stored in fixed-capacity slots allocated once:
+    - conditioning frames (the frames with prompts) are pinned in their own slots
+    - the other frames are kept in a sliding window of the most recent ones
+The arrays are stored in a compact dtype (float16 by default), and the entries evicted from the window (or from
+the conditioning slots when they are full) could be spilled to a file in the SharedSpacePath, so they can be
+recalled later. Thus the resident memory does not grow with the length of the sequence (the frame -> record
+table of a spill file is memory-mapped as well), and looking up a frame is a dict or an array query.
+"""
+
+import os
+import shutil
+import tempfile
+import logging as log
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from sam2.configs import B, Path
+
+# field name -> shape of the memories of sam2.1 models with 1024x1024 input
+SAM2_MEMORY_FIELDS = OrderedDict([
+    ("maskmem_features", (64, 64, 64)),
+    ("maskmem_pos_enc", (64, 64, 64)),
+    ("obj_ptr", (256,)),
+])
+
+
+class MemoryBankError(Exception): pass
+class FrameNotInMemory(MemoryBankError): pass
+
+
+class SpillFile(object):
+    """
+    Evicted entries are appended to a file as fixed-size records (all fields one after another), and read back
+    into a recall buffer allocated once. The record of each frame is found in a memory-mapped table indexed by
+    the frame number ("<file>.idx", -1 for the frames not spilled), which grows on disk, not in memory.
+    """
+    INDEX_DTYPE = np.dtype('<i4')
+    INDEX_CAPACITY = 4096
+
+    def __init__(self, file_name: str, fields: Dict[str, Tuple[int]], dtype) -> None:
+        self._file_name = file_name
+        self._file = open(file_name, 'w+b')
+        self._dtype = np.dtype(dtype)
+        self._recall = OrderedDict((k, np.empty(shape, self._dtype)) for k, shape in fields.items())
+        self._record_size = sum(v.nbytes for v in self._recall.values())
+        self._index_name = f"{file_name}.idx"
+        self._records = np.memmap(self._index_name, dtype=self.INDEX_DTYPE, mode='w+', shape=(self.INDEX_CAPACITY,))
+        self._records[:] = -1
+        self._n_records = 0
+
+    def _record(self, frame) -> int:
+        frame = int(frame)
+        return int(self._records[frame]) if 0 <= frame < len(self._records) else -1
+
+    def _grow(self, frame: int) -> None:
+        capacity = len(self._records)
+        while capacity <= frame: capacity *= 2
+        self._records.flush()
+        del self._records
+        with open(self._index_name, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            np.full(capacity - f.tell() // self.INDEX_DTYPE.itemsize, -1, self.INDEX_DTYPE).tofile(f)
+        self._records = np.memmap(self._index_name, dtype=self.INDEX_DTYPE, mode='r+', shape=(capacity,))
+
+    def __contains__(self, frame): return self._record(frame) >= 0
+
+    def __len__(self): return self._n_records
+
+    @property
+    def nbytes(self) -> int: return self._n_records * self._record_size
+
+    def write(self, frame: int, entry: Dict[str, np.ndarray]) -> None:
+        frame = int(frame)
+        if frame < 0:
+            raise ValueError(f'Frame {frame} cannot be spilled!')
+        # a frame evicted again overwrites its own record
+        record = self._record(frame)
+        if record < 0:
+            if frame >= len(self._records):
+                self._grow(frame)
+            record = self._n_records
+            self._n_records += 1
+            self._records[frame] = record
+        self._file.seek(record * self._record_size)
+        for k in self._recall:
+            self._file.write(memoryview(np.ascontiguousarray(entry[k], dtype=self._dtype)).cast('B'))
+
+    def read(self, frame: int) -> Dict[str, np.ndarray]:
+        """ :return: Views of the recall buffer, they are overwritten by the next read """
+        record = self._record(frame)
+        if record < 0:
+            raise FrameNotInMemory(frame)
+        self._file.flush()
+        self._file.seek(record * self._record_size)
+        for v in self._recall.values():
+            self._file.readinto(memoryview(v).cast('B'))
+        return self._recall
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        self._records = np.zeros(0, self.INDEX_DTYPE)
+        for file_name in (self._file_name, self._index_name):
+            try:
+                os.remove(file_name)
+            except FileNotFoundError:
+                pass
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ObjectMemory(object):
+    def __init__(self, fields: Dict[str, Tuple[int]] = SAM2_MEMORY_FIELDS, num_cond=4, num_recent=6,
+                 dtype=np.float16, spill_file: str = None) -> None:
+        """
+        :param fields: The name and shape of each array in an entry
+        :param num_cond: The number of pinned conditioning slots
+        :param num_recent: The size of the sliding window of the non-conditioning frames
+        :param dtype: The dtype of the stored arrays
+        :param spill_file: If given, evicted entries are spilled to this file, else they are dropped
+        """
+        self.fields = OrderedDict((k, tuple(v)) for k, v in fields.items())
+        self.num_cond, self.num_recent = int(num_cond), int(num_recent)
+        self.dtype = np.dtype(dtype)
+        capacity = self.num_cond + self.num_recent
+        self._slots = OrderedDict((k, np.zeros((capacity,) + shape, self.dtype)) for k, shape in self.fields.items())
+        self._slot_frame = np.full(capacity, -1, np.int64)
+        self._frame_slot = {}
+        self._cond_order = []     # conditioning frames in insertion order
+        self._recent_order = []   # non-conditioning frames from the oldest to the newest
+        self._spill = SpillFile(spill_file, self.fields, self.dtype) if spill_file is not None else None
+
+    def __contains__(self, frame): return frame in self._frame_slot or (self._spill is not None and frame in self._spill)
+
+    def __len__(self): return len(self._frame_slot)
+
+    @property
+    def cond_frames(self) -> List[int]: return list(self._cond_order)
+
+    @property
+    def recent_frames(self) -> List[int]: return list(self._recent_order)
+
+    def _evict(self, frame):
+        slot = self._frame_slot.pop(frame)
+        if self._spill is not None:
+            self._spill.write(frame, {k: v[slot] for k, v in self._slots.items()})
+        self._slot_frame[slot] = -1
+        return slot
+
+    def _free_slot(self, cond) -> int:
+        if cond:
+            base, size, order = 0, self.num_cond, self._cond_order
+        else:
+            base, size, order = self.num_cond, self.num_recent, self._recent_order
+        if size == 0:
+            raise MemoryBankError(f'No {"conditioning" if cond else "recent"} slots!')
+        if len(order) < size:
+            used = self._slot_frame[base: base + size]
+            return base + int(np.flatnonzero(used < 0)[0])
+        return self._evict(order.pop(0))
+
+    def put(self, frame: int, entry: Dict[str, np.ndarray], cond=False) -> None:
+        """ Store the memory of a frame, the arrays are converted to the storage dtype """
+        frame = int(frame)
+        slot = self._frame_slot.get(frame)
+        if slot is not None and (slot < self.num_cond) != cond:
+            # the frame is moved between the conditioning slots and the window
+            (self._cond_order if slot < self.num_cond else self._recent_order).remove(frame)
+            self._frame_slot.pop(frame)
+            self._slot_frame[slot] = -1
+            slot = None
+        if slot is None:
+            slot = self._free_slot(cond)
+            self._frame_slot[frame] = slot
+            self._slot_frame[slot] = frame
+            (self._cond_order if cond else self._recent_order).append(frame)
+        for k, v in self._slots.items():
+            np.copyto(v[slot], entry[k], casting='unsafe')
+
+    def get(self, frame: int, recall=True) -> Dict[str, np.ndarray]:
+        """
+        :param recall: If true, a frame not in the slots is read back from the spill file
+        :return: Views of the stored arrays (read-only by convention)
+        """
+        slot = self._frame_slot.get(int(frame))
+        if slot is not None:
+            return OrderedDict((k, v[slot]) for k, v in self._slots.items())
+        if recall and self._spill is not None and frame in self._spill:
+            return self._spill.read(int(frame))
+        raise FrameNotInMemory(frame)
+
+    def stacked(self, frames: List[int] = None) -> Dict[str, np.ndarray]:
+        """ The arrays of the given resident frames (all of them by default, cond first) stacked in order """
+        if frames is None:
+            frames = self._cond_order + self._recent_order
+        slots = [self._frame_slot[f] for f in frames]
+        return OrderedDict((k, v[slots]) for k, v in self._slots.items())
+
+    def memory_usage(self) -> Dict[str, int]:
+        return {
+            "resident_bytes": sum(v.nbytes for v in self._slots.values()),
+            "resident_frames": len(self._frame_slot),
+            "spilled_bytes": self._spill.nbytes if self._spill is not None else 0,
+            "spilled_frames": len(self._spill) if self._spill is not None else 0,
+        }
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+
+
+def _remove_stale_spill_dirs(spill_dir: str) -> None:
+    """ Remove the "<pid>-<unique>" directories left by the processes which died without closing their banks """
+    with os.scandir(spill_dir) as it:
+        for entry in it:
+            pid = entry.name.split('-', 1)[0]
+            if not entry.is_dir() or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                log.debug('Stale spill directory %s is removed.' % entry.path)
+                shutil.rmtree(entry.path, ignore_errors=True)
+            except OSError:
+                pass
+
+
+class MemoryBank(object):
+    def __init__(self, fields: Dict[str, Tuple[int]] = SAM2_MEMORY_FIELDS, num_cond=4, num_recent=6,
+                 dtype=np.float16, spill=False, spill_dir: [str, Path] = B) -> None:
+        """
+        :param spill: If true, evicted entries are spilled to "<spill_dir>/<pid>-<unique>/<object id>.bin", the
+                      directories left by dead processes are removed
+        """
+        self._args = dict(fields=fields, num_cond=num_cond, num_recent=num_recent, dtype=dtype)
+        self._spill_dir = None
+        if spill:
+            spill_dir = Path(str(spill_dir)).create()
+            _remove_stale_spill_dirs(str(spill_dir))
+            self._spill_dir = Path(tempfile.mkdtemp(prefix=f"{os.getpid()}-", dir=str(spill_dir)))
+        self._objects: Dict[int, ObjectMemory] = OrderedDict()
+
+    def __getitem__(self, obj_id) -> ObjectMemory:
+        obj = self._objects.get(obj_id)
+        if obj is None:
+            spill_file = None
+            if self._spill_dir is not None:
+                spill_file = self._spill_dir(f"{obj_id}.bin")
+            obj = self._objects[obj_id] = ObjectMemory(spill_file=spill_file, **self._args)
+            log.debug('Memory of object %s is created. (%s)' % (obj_id, obj.memory_usage()))
+        return obj
+
+    def __contains__(self, obj_id): return obj_id in self._objects
+
+    def objects(self) -> List: return list(self._objects.keys())
+
+    def put(self, obj_id, frame: int, entry: Dict[str, np.ndarray], cond=False) -> None:
+        self[obj_id].put(frame, entry, cond=cond)
+
+    def get(self, obj_id, frame: int, recall=True) -> Dict[str, np.ndarray]:
+        obj = self._objects.get(obj_id)
+        if obj is None:
+            raise FrameNotInMemory(f'object {obj_id} frame {frame}')
+        return obj.get(frame, recall=recall)
+
+    def remove(self, obj_id) -> None:
+        obj = self._objects.pop(obj_id, None)
+        if obj is not None:
+            obj.close()
+
+    def memory_usage(self) -> Dict:
+        """ :return: Memory use of each object """
+        return OrderedDict((k, v.memory_usage()) for k, v in self._objects.items())
+
+    def close(self):
+        for obj_id in list(self._objects.keys()):
+            self.remove(obj_id)
+        if self._spill_dir is not None:
+            try:
+                os.rmdir(str(self._spill_dir))
+            except OSError:
+                pass
+            Path.invalidate(str(self._spill_dir))
+            self._spill_dir = None
+
+    def __enter__(self): return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb): self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
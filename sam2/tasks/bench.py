@@ -0,0 +1,455 @@
+"""
+Benchmarks of the hot paths of this project, all of them run on synthetic data (no GPU or network is required):
+    python -m sam2 bench [--quick] [--only datablock registry ...] [--compare baseline.json]
+
+The results are written as json into "<OutputPath>/bench", and can be compared with a saved baseline, any
+metric worse than the baseline by more than the tolerance, or missing from this run, is reported as a regression.
+A failed scenario or a regression makes the exit code 1.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import subprocess
+import multiprocessing as mp
+from queue import Empty
+from collections import OrderedDict
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from sam2.configs import O, R, Path, LOGGER_CONFIG_FILE, get_timestamp_now
+
+SCENARIOS: Dict[str, Callable] = OrderedDict()
+
+
+def scenario(name):
+    def _register(func):
+        SCENARIOS[name] = func
+        return func
+    return _register
+
+
+def metric(name, value, unit, higher_is_better) -> Dict:
+    return {"name": name, "value": float(value), "unit": unit, "higher_is_better": higher_is_better}
+
+
+def timeit(func, repeat=3) -> float:
+    """ :return: The median of the wall time (seconds) of func() """
+    times = []
+    for _ in range(max(1, repeat)):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    return float(np.median(times))
+
+
+def wait_result(p, queue, what="process", poll=0.5):
+    """
+    Get the result put by the child process p into queue, a child which dies without reporting (killed by a signal,
+    os._exit, a crash in native code) raises RuntimeError instead of blocking forever.
+    """
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except Empty:
+            if p.is_alive():
+                continue
+        # the result could be put right before the exit
+        try:
+            return queue.get(timeout=poll)
+        except Empty:
+            p.join()
+            raise RuntimeError(f"The {what} died without reporting a result (exit code {p.exitcode})")
+
+
+def run_isolated(func, *args):
+    """
+    Run func in a forked process, so the shared memory pool (created when sam2.utils.storage is imported) is
+    owned and released by that process only.
+    """
+    ctx = mp.get_context('fork')
+    queue = ctx.Queue()
+
+    def _target():
+        try:
+            queue.put(("ok", func(*args)))
+        except Exception as e:
+            queue.put(("error", f"{type(e).__name__}: {e}"))
+
+    p = ctx.Process(target=_target)
+    p.start()
+    state, result = wait_result(p, queue, "isolated scenario process")
+    p.join()
+    if state != "ok":
+        raise RuntimeError(result)
+    return result
+
+
+"""
+Data pool
+"""
+
+def _datablock_reader(msgs, queue):
+    from sam2.utils.storage import DataBlock
+    t = time.perf_counter()
+    total = 0.0
+    for msg in msgs:
+        block = DataBlock(name=msg)
+        DataBlock._blocks_dict[block.Name] = block
+        total += float(block.Data.sum())
+        block.close()
+    queue.put(time.perf_counter() - t)
+
+
+def _datablock(n, shape):
+    from sam2.utils.storage import DataBlock, close_pool
+    ctx = mp.get_context('fork')
+    data = np.ones(shape, np.float32)
+    pid = os.getpid()
+    try:
+        t = time.perf_counter()
+        blocks = []
+        for i in range(n):
+            block = DataBlock(data=data, name=f"sam2bench_{pid}_{i}")
+            block[...] = data
+            block.push()
+            blocks.append(block)
+        t_create = time.perf_counter() - t
+
+        msgs = [f"{b.Name};{','.join(map(str, shape))};float32;{pid};0" for b in blocks]
+        queue = ctx.Queue()
+        p = ctx.Process(target=_datablock_reader, args=(msgs, queue))
+        p.start()
+        t_read = wait_result(p, queue, "datablock reader")
+        p.join()
+        for b in blocks:
+            b.close()
+    finally:
+        close_pool()
+    return t_create, t_read
+
+
+@scenario("datablock")
+def bench_datablock(opts) -> List[Dict]:
+    n = 50 if opts["quick"] else 200
+    shape = (256, 256, 3)
+    t_create, t_read = run_isolated(_datablock, n, shape)
+    mb = n * np.prod(shape) * 4 / 2 ** 20
+    return [
+        metric("create_push_ops", n / t_create, "ops/s", True),
+        metric("create_push_throughput", mb / t_create, "MB/s", True),
+        metric("attach_read_ops", n / t_read, "ops/s", True),
+        metric("attach_read_throughput", mb / t_read, "MB/s", True),
+    ]
+
+
+def _registry_watcher(names, ready, found):
+    from sam2.utils.storage import DataBlock, BlockNotExist, datapool_threading
+    datapool_threading()
+    ready.set()
+    for name in names:
+        while True:
+            try:
+                DataBlock.get_block(name)
+                break
+            except BlockNotExist:
+                time.sleep(0.001)
+        found.put(time.monotonic())
+
+
+def _registry(n):
+    from sam2.utils.storage import DataBlock, close_pool
+    ctx = mp.get_context('fork')
+    names = [f"sam2reg_{os.getpid()}_{i}" for i in range(n)]
+    ready, found = ctx.Event(), ctx.Queue()
+    latencies = []
+    try:
+        p = ctx.Process(target=_registry_watcher, args=(names, ready, found), daemon=True)
+        p.start()
+        ready.wait()
+        for name in names:
+            block = DataBlock(data=np.zeros(16, np.uint8), name=name)
+            t = time.monotonic()
+            block.push()
+            latencies.append(found.get(timeout=30) - t)
+            block.close()
+        p.join(timeout=5)
+    finally:
+        close_pool()
+    return latencies
+
+
+@scenario("registry")
+def bench_registry(opts) -> List[Dict]:
+    latencies = run_isolated(_registry, 2 if opts["quick"] else 5)
+    return [
+        metric("discovery_latency_median", np.median(latencies) * 1e3, "ms", False),
+        metric("discovery_latency_max", np.max(latencies) * 1e3, "ms", False),
+    ]
+
+
+"""
+File system and decoding
+"""
+
+@scenario("read_sequence")
+def bench_read_sequence(opts) -> List[Dict]:
+    from sam2.utils.io import read_sequence
+    results = []
+    for n in ((1000, 10000) if opts["quick"] else (10000, 100000)):
+        seq_dir = tempfile.mkdtemp(prefix="sam2bench_seq_", dir=opts["workdir"])
+        try:
+            for i in range(n):
+                os.close(os.open(os.path.join(seq_dir, f"{i:08d}.jpg"), os.O_CREAT | os.O_WRONLY))
+            t = timeit(lambda: read_sequence(seq_dir, refresh=True), opts["repeat"])
+            t_cached = timeit(lambda: read_sequence(seq_dir, refresh=False), opts["repeat"])
+        finally:
+            shutil.rmtree(seq_dir, ignore_errors=True)
+            Path.invalidate(seq_dir)
+        results.append(metric(f"scan_{n}", t * 1e3, "ms", False))
+        results.append(metric(f"scan_{n}_cached", t_cached * 1e3, "ms", False))
+    return results
+
+
+@scenario("path_cache")
+def bench_path_cache(opts) -> List[Dict]:
+    """ The metadata system calls of the per-frame path handling: cache directory, frame file and sequence """
+    n = 1000 if opts["quick"] else 10000
+    root = tempfile.mkdtemp(prefix="sam2bench_path_", dir=opts["workdir"])
+    for i in range(10):
+        os.close(os.open(os.path.join(root, f"{i:06d}.jpg"), os.O_CREAT | os.O_WRONLY))
+    from sam2.utils.io import read_sequence
+
+    def _per_frame():
+        seq = Path(root)
+        for i in range(n):
+            (seq + "cache").create()
+            seq(f"{i % 10:06d}.jpg")
+            (seq + f"{i % 10:06d}.jpg").exists()
+            read_sequence(seq, refresh=False)
+
+    results = []
+    ttl = Path.STAT_TTL
+    try:
+        for name, cache_ttl in (("uncached", 0.0), ("cached", ttl)):
+            Path.STAT_TTL = cache_ttl
+            Path.invalidate()
+            Path.syscall_stats(reset=True)
+            t = timeit(_per_frame, 1)
+            stats = Path.syscall_stats(reset=True)
+            calls = stats["stat"] + stats["scandir"] + stats["makedirs"]
+            results.append(metric(f"syscalls_per_frame_{name}", calls / n, "calls", False))
+            results.append(metric(f"time_per_frame_{name}", t / n * 1e6, "us", False))
+    finally:
+        Path.STAT_TTL = ttl
+        Path.invalidate()
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def _synthetic_frame(h, w, seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:h, 0:w]
+    base = np.stack([x * 255 // max(w - 1, 1), y * 255 // max(h - 1, 1), (x + y) * 255 // max(h + w - 2, 1)], -1)
+    return np.clip(base + rng.integers(-20, 20, (h, w, 3)), 0, 255).astype(np.uint8)
+
+
+@scenario("image_decode")
+def bench_image_decode(opts) -> List[Dict]:
+    import cv2
+    frame = _synthetic_frame(1080, 1920)
+    n = 10 if opts["quick"] else 50
+    results = []
+    for ext in (".jpg", ".png"):
+        ok, buf = cv2.imencode(ext, frame)
+        t = timeit(lambda: [cv2.imdecode(buf, cv2.IMREAD_COLOR) for _ in range(n)], opts["repeat"])
+        results.append(metric(f"decode_{ext[1:]}_1080p", n / t, "frames/s", True))
+    return results
+
+
+@scenario("frame_cache")
+def bench_frame_cache(opts) -> List[Dict]:
+    import cv2
+    from sam2.utils.io import read_sequence
+    n = 20 if opts["quick"] else 100
+    frames = [_synthetic_frame(720, 1280, seed=i) for i in range(4)]
+    cache_dir = tempfile.mkdtemp(prefix="sam2bench_cache_", dir=opts["workdir"])
+    try:
+        def _write():
+            for i in range(n):
+                cv2.imwrite(os.path.join(cache_dir, f"{i:06d}.jpg"), frames[i % len(frames)])
+
+        def _read():
+            for f in read_sequence(cache_dir):
+                cv2.imread(f, cv2.IMREAD_COLOR)
+
+        t_write = timeit(_write, opts["repeat"])
+        t_read = timeit(_read, opts["repeat"])
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return [
+        metric("write_720p", n / t_write, "frames/s", True),
+        metric("read_720p", n / t_read, "frames/s", True),
+    ]
+
+
+"""
+Logging and import
+"""
+
+@scenario("logging")
+def bench_logging(opts) -> List[Dict]:
+    with open(LOGGER_CONFIG_FILE) as f:
+        fmt = json.load(f)["default"]["format_file"]
+    n = 2000 if opts["quick"] else 20000
+    log_dir = tempfile.mkdtemp(prefix="sam2bench_log_", dir=opts["workdir"])
+    logger = logging.getLogger(f"sam2bench.{os.getpid()}")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    fh = logging.FileHandler(os.path.join(log_dir, "bench.log"), 'w')
+    fh.setFormatter(logging.Formatter(fmt))
+    logger.addHandler(fh)
+    try:
+        t_emit = timeit(lambda: [logger.info("frame %d: %d objects", i, 3) for i in range(n)], opts["repeat"])
+        t_skip = timeit(lambda: [logger.debug("frame %d: %d objects", i, 3) for i in range(n)], opts["repeat"])
+    finally:
+        logger.removeHandler(fh)
+        fh.close()
+        shutil.rmtree(log_dir, ignore_errors=True)
+    return [
+        metric("emit_per_record", t_emit / n * 1e6, "us", False),
+        metric("filtered_per_record", t_skip / n * 1e6, "us", False),
+    ]
+
+
+IMPORT_MODULES = ("sam2.configs", "sam2.utils.io", "sam2.utils.storage", "sam2.modules.data_process")
+
+
+@scenario("import")
+def bench_import(opts) -> List[Dict]:
+    # importing the modules creates no directories, the output and logs directories are created on first use
+    def _run(code):
+        t = time.perf_counter()
+        res = subprocess.run([sys.executable, "-c", code], cwd=R(), capture_output=True, text=True)
+        if res.returncode != 0:
+            raise RuntimeError(res.stderr.strip().splitlines()[-1] if res.stderr else code)
+        return time.perf_counter() - t
+
+    repeat = max(3, opts["repeat"])
+    t_python = float(np.median([_run("pass") for _ in range(repeat)]))
+    results = [metric("python_startup", t_python * 1e3, "ms", False)]
+    for module in IMPORT_MODULES:
+        try:
+            t = float(np.median([_run(f"import {module}") for _ in range(repeat)]))
+        except RuntimeError as e:
+            logging.warning("Import of %s is skipped. (reason: %s)" % (module, e))
+            continue
+        results.append(metric(f"import_{module}", (t - t_python) * 1e3, "ms", False))
+    return results
+
+
+"""
+Task
+"""
+
+def compare(results: Dict, baseline: Dict, tolerance: float, scenarios=None) -> List[str]:
+    """
+    :param scenarios: The scenarios run this time (all of the baseline by default), a scenario or a metric of them
+                      in the baseline but missing in the results is a regression as well
+    :return: Messages of the regressed metrics
+    """
+    regressions = []
+    old_results = baseline.get("results", {})
+    scenarios = old_results.keys() if scenarios is None else scenarios
+    for name in scenarios:
+        if name in old_results and name not in results["results"]:
+            regressions.append(f"{name}: scenario is missing (failed: {name in results.get('failed', {})})")
+    for name, metrics in results["results"].items():
+        old = {m["name"]: m for m in old_results.get(name, [])}
+        new_names = {m["name"] for m in metrics}
+        for missing in sorted(set(old.keys()) - new_names):
+            regressions.append(f"{name}.{missing}: metric is missing")
+        for m in metrics:
+            b = old.get(m["name"])
+            if b is None or b["value"] == 0:
+                continue
+            ratio = m["value"] / b["value"]
+            worse = ratio < 1 - tolerance if m["higher_is_better"] else ratio > 1 + tolerance
+            if worse:
+                regressions.append(f"{name}.{m['name']}: {b['value']:.4g} -> {m['value']:.4g} {m['unit']} "
+                                   f"({(ratio - 1) * 100:+.1f}%)")
+    return regressions
+
+
+class Bench(object):
+
+    def __init__(self, only=None, quick=False, repeat=3, workdir=None, compare=None, tolerance=0.1,
+                 save_baseline=None, output=None):
+        self._only = only if only else list(SCENARIOS.keys())
+        self._opts = {"quick": quick, "repeat": repeat, "workdir": workdir}
+        self._compare = compare
+        self._tolerance = tolerance
+        self._save_baseline = save_baseline
+        self._output = output
+
+    @classmethod
+    def add_arguments(cls, parser):
+        parser.add_argument("--only", nargs="+", choices=list(SCENARIOS.keys()), help="Scenarios to run")
+        parser.add_argument("--quick", action="store_true", help="Smaller data sizes, for a fast check")
+        parser.add_argument("--repeat", type=int, default=3, help="Repeats of each timing, the median is taken")
+        parser.add_argument("--workdir", default=None, help="Directory of the temporary files (default: system)")
+        parser.add_argument("--compare", default=None, help="A saved result json to compare with")
+        parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative slowdown")
+        parser.add_argument("--save-baseline", default=None, help="Also save the result json to this file")
+        parser.add_argument("--output", default=None, help="Result json file (default: <OutputPath>/bench)")
+
+    def main(self):
+        results = OrderedDict()
+        failed = OrderedDict()
+        for name in SCENARIOS:
+            if name not in self._only:
+                continue
+            print(f"[bench] {name} ...", flush=True)
+            try:
+                results[name] = SCENARIOS[name](self._opts)
+            except Exception as e:
+                logging.error("Scenario %s failed. (reason: %s)" % (name, e))
+                failed[name] = f"{type(e).__name__}: {e}"
+                continue
+            for m in results[name]:
+                print(f"    {m['name']:<36s} {m['value']:>12.4g} {m['unit']}")
+
+        report = {
+            "timestamp": get_timestamp_now(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "options": self._opts,
+            "results": results,
+            "failed": failed,
+        }
+        output = self._output if self._output else (O + "bench").create()(f"bench_{report['timestamp']}.json")
+        for file_name in filter(None, (output, self._save_baseline)):
+            with open(file_name, 'w') as f:
+                json.dump(report, f, indent=2)
+        print(f"[bench] results are written to {output}")
+
+        for name, reason in failed.items():
+            print(f"[bench] FAILED {name}: {reason}")
+        if self._compare is None:
+            return 1 if failed else 0
+        with open(self._compare) as f:
+            baseline = json.load(f)
+        ran = [name for name in SCENARIOS if name in self._only]
+        regressions = compare(report, baseline, self._tolerance, scenarios=ran)
+        for r in regressions:
+            print(f"[bench] REGRESSION {r}")
+        if not regressions and not failed:
+            print(f"[bench] no regression against {self._compare} (tolerance {self._tolerance * 100:.0f}%)")
+        return 1 if regressions or failed else 0
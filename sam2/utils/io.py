@@ -16,26 +16,32 @@ def video_reader_async(video_file, datapool_name):
 
 IMAGE_FORMATS = ('.jpeg', '.jpg', '.gif', '.png', '.bmp', '.tiff', '.tif')
 
-def read_sequence(seq_dir, abs_name=True, full_path=True, reverse=False) -> List[str]:
+def read_sequence(seq_dir, abs_name=True, full_path=True, reverse=False, refresh=True) -> List[str]:
     """ :param seq_dir: The directory that contains a bunch of images in any picture format (.png, .jpg, ...)
         :param abs_name: If true, the picture name will be transferred to float type to sort
         :param full_path: If true, the picture name will be stored with full-absolute path, else it is only picture name
         :param reverse: If true, the sequence is returned with reversed order
+        :param refresh: If true (default), the directory is listed again. If false, a listing cached in the last
+                        Path.STAT_TTL seconds is used (see Path.scan), the images added since then are missed, so it
+                        is only for the hot loops reading a directory which is not being filled
         :return: A list of absolute paths/image names to all images in seq_dir (sorted by name)
     """
-    if os.path.exists(seq_dir):
-        imgs = [f for f in os.listdir(seq_dir) if f.lower().endswith(IMAGE_FORMATS)]
-        if len(imgs) == 0:
-            raise FileNotFoundError('No images found in {}!'.format(seq_dir))
-        if abs_name:
-            imgs.sort(key=lambda f: float(os.path.splitext(f)[0]), reverse=reverse)
-        else:
-            imgs.sort(reverse=reverse)
-        if full_path:
-            return [os.path.join(seq_dir, f) for f in imgs]
-        else:
-            return imgs
-    raise FileNotFoundError(f'seq_dir {seq_dir} not found!')
+    seq_dir = seq_dir if isinstance(seq_dir, Path) else Path(seq_dir)
+    try:
+        entries = seq_dir.scan(IMAGE_FORMATS, refresh=refresh)
+    except (FileNotFoundError, NotADirectoryError):
+        raise FileNotFoundError(f'seq_dir {seq_dir} not found!')
+    if len(entries) == 0:
+        raise FileNotFoundError('No images found in {}!'.format(seq_dir))
+    imgs = [e.name for e in entries]
+    if abs_name:
+        imgs.sort(key=lambda f: float(os.path.splitext(f)[0]), reverse=reverse)
+    else:
+        imgs.sort(reverse=reverse)
+    if full_path:
+        return [os.path.join(seq_dir.value(), f) for f in imgs]
+    else:
+        return imgs
 
 VIDEO_FORMATS = ('.mp4', '.avi', '.mov')
 def read_video_with_opencv(video_file, using_cache=True) -> List[str]:
@@ -82,11 +88,13 @@ def read_video_with_ffmpeg(video_file, using_cache=True) -> List[str]:
     if using_cache:
         seq_cache_dirname = __get_code_with_filename(video_file)
         full_cache_dir = (Q + f"{seq_cache_dirname}")
-        if os.path.exists(full_cache_dir):
+        if full_cache_dir.exists():
             pass
         else:
-            os.makedirs(full_cache_dir)
+            full_cache_dir.create()
             ffmpeg.input(video_file).output(f'{output_format}%06d).run()')
+            # the frames are new, a cached listing of the directory is out of date
+            Path.invalidate(full_cache_dir.value())
     else:
         pass
 
@@ -128,6 +136,21 @@ def read_file_auto(file_name: [str, Path], **kwargs):
 
 Read = read_file_auto
 
+_READ_CACHE = {}
+
+def read_file_cached(file_name: [str, Path], **kwargs):
+    """
+    Same as read_file_auto, but the parsed contents are kept until the file is modified, so that the configs are
+    parsed only once by a long-lived process (e.g. a daemon worker). The returned contents must not be modified.
+    """
+    file_name = file_name.value() if isinstance(file_name, Path) else file_name
+    st = os.stat(file_name)
+    key = (os.path.abspath(file_name), st.st_mtime_ns, st.st_size, tuple(sorted(kwargs.items())))
+    contents = _READ_CACHE.get(key)
+    if contents is None:
+        contents = _READ_CACHE[key] = read_file_auto(file_name, **kwargs)
+    return contents
+
 if __name__ == '__main__':
     # print(read_sequence("/data/vot2022-longterm/sequences/bicycle/color", full_path=False))
     read_video("/data/test_tree/tree3.mp4")
\ No newline at end of file
@@ -0,0 +1,440 @@
+"""
+Compact storage of the binary masks produced by tracking.
+
+The masks are run-length encoded in the same way as COCO: the pixels are read in column-major (Fortran) order,
+and the counts alternate between runs of 0 and runs of 1, always starting with a (possibly empty) run of 0.
+So the counts can be exported to (or imported from) the pycocotools RLE format directly.
+
+A mask store is a directory:
+    - meta.json     height and width of the masks
+    - counts.bin    uint32 counts of all masks, appended one after another
+    - index.bin     one INDEX_DTYPE record per mask (frame, object id, position in counts.bin, area)
+
+Both files are append-only, so that the store could be written frame by frame during tracking, and read with
+random access (by frame and object id) through memory mapping afterwards.
+"""
+
+import os
+import json
+import logging as log
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from sam2.configs import O, Path
+
+INDEX_DTYPE = np.dtype([('frame', '<i8'), ('obj', '<i4'), ('length', '<i4'), ('offset', '<i8'), ('area', '<i8')])
+COUNTS_DTYPE = np.dtype('<u4')
+
+
+class MaskStoreError(Exception): pass
+class MaskNotExist(MaskStoreError): pass
+class MaskSizeMismatch(MaskStoreError): pass
+
+
+"""
+Vectorized encoding/decoding
+"""
+
+def encode_batch(masks: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param masks: (n, h, w) masks, any dtype, non-zero is foreground
+    :return: (counts, lengths), counts of all masks concatenated (uint32), and the number of counts of each mask
+    """
+    n, h, w = masks.shape
+    hw = h * w
+    if n == 0 or hw == 0:
+        return np.zeros(0, COUNTS_DTYPE), np.zeros(n, np.int64)
+    flat = masks.transpose(0, 2, 1).reshape(n, hw).astype(bool, copy=False)
+    rows, cols = np.nonzero(flat[:, 1:] != flat[:, :-1])
+    k = np.bincount(rows, minlength=n)
+
+    # boundaries of each mask: [0, change points..., hw]
+    seg_off = np.zeros(n + 1, np.int64)
+    np.cumsum(k + 2, out=seg_off[1:])
+    bounds = np.empty(seg_off[-1], np.int64)
+    inner = np.ones(seg_off[-1], bool)
+    inner[seg_off[:-1]] = False
+    inner[seg_off[1:] - 1] = False
+    bounds[seg_off[:-1]] = 0
+    bounds[seg_off[1:] - 1] = hw
+    bounds[inner] = cols + 1
+
+    steps = np.diff(bounds)
+    keep = np.ones(steps.shape[0], bool)
+    keep[seg_off[1:-1] - 1] = False
+    counts = steps[keep]
+
+    # masks start with a 1 need an empty run of 0 in front
+    first = flat[:, 0]
+    lengths = k + 1
+    if first.any():
+        cnt_off = np.zeros(n, np.int64)
+        np.cumsum(lengths[:-1], out=cnt_off[1:])
+        counts = np.insert(counts, cnt_off[first], 0)
+        lengths = lengths + first
+    return counts.astype(COUNTS_DTYPE), lengths
+
+
+def encode(mask: np.ndarray) -> np.ndarray:
+    return encode_batch(mask[None])[0]
+
+
+def split_counts(counts: np.ndarray, lengths: np.ndarray) -> List[np.ndarray]:
+    return np.split(counts, np.cumsum(lengths)[:-1])
+
+
+def areas_batch(counts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """ Areas of the concatenated counts, without decoding """
+    if len(lengths) == 0:
+        return np.zeros(0, np.int64)
+    starts = np.zeros(len(lengths), np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    odd = (np.arange(counts.shape[0]) - np.repeat(starts, lengths)) & 1
+    return np.add.reduceat(counts.astype(np.int64) * odd, starts)
+
+
+def area(counts: np.ndarray) -> int:
+    return int(counts[1::2].sum(dtype=np.int64))
+
+
+def bbox(counts: np.ndarray, h: int) -> Tuple[int, int, int, int]:
+    """ :return: (x, y, w, h) of the mask, without decoding """
+    if len(counts) < 2:
+        return 0, 0, 0, 0
+    b = np.cumsum(counts, dtype=np.int64)
+    starts, ends = b[0:-1:2], b[1::2] - 1
+    x0, x1 = int(starts[0] // h), int(ends[-1] // h)
+    if np.any(starts // h != ends // h):
+        # a run across columns covers both the last and the first row
+        y0, y1 = 0, h - 1
+    else:
+        y0, y1 = int((starts % h).min()), int((ends % h).max())
+    return x0, y0, x1 - x0 + 1, y1 - y0 + 1
+
+
+class RLEDecoder(object):
+    """ Decode the counts into preallocated arrays, the scratch buffers are allocated only once """
+    def __init__(self, height, width) -> None:
+        self.height, self.width = int(height), int(width)
+        hw = self.height * self.width
+        self._diff = np.zeros(hw + 1, np.int8)
+        self._flat = np.empty(hw, np.int8)
+
+    def decode(self, counts: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        h, w = self.height, self.width
+        if out is None:
+            out = np.empty((h, w), bool)
+        b = np.cumsum(counts, dtype=np.int64)
+        if b.shape[0] == 0 or b[-1] != h * w:
+            raise MaskSizeMismatch(f'counts sum {b[-1] if b.shape[0] else 0} != {h}x{w}')
+        self._diff[:] = 0
+        # add.at accumulates the marks at the same position, so zero-length runs cancel out correctly
+        np.add.at(self._diff, b[0:-1:2], 1)
+        np.add.at(self._diff, b[1::2], -1)
+        np.cumsum(self._diff[:-1], out=self._flat)
+        np.copyto(out, self._flat.reshape(w, h).T, casting='unsafe')
+        return out
+
+    def decode_batch(self, counts_list: List[np.ndarray], out: np.ndarray = None) -> np.ndarray:
+        if out is None:
+            out = np.empty((len(counts_list), self.height, self.width), bool)
+        for i, counts in enumerate(counts_list):
+            self.decode(counts, out=out[i])
+        return out[:len(counts_list)]
+
+
+def decode(counts: np.ndarray, h: int, w: int, out: np.ndarray = None) -> np.ndarray:
+    return RLEDecoder(h, w).decode(counts, out=out)
+
+
+"""
+Operations on RLE
+"""
+
+def iou(counts_a: np.ndarray, counts_b: np.ndarray) -> float:
+    """ IoU of two masks (same size) computed on the run boundaries, without decoding """
+    ba = np.concatenate(([0], np.cumsum(counts_a, dtype=np.int64)))
+    bb = np.concatenate(([0], np.cumsum(counts_b, dtype=np.int64)))
+    if ba[-1] != bb[-1]:
+        raise MaskSizeMismatch(f'{ba[-1]} != {bb[-1]}')
+    points = np.union1d(ba, bb)
+    seg = np.diff(points)
+    # value of each segment: the index of the run it falls in, odd runs are 1
+    va = (np.searchsorted(ba, points[:-1], side='right') - 1) & 1
+    vb = (np.searchsorted(bb, points[:-1], side='right') - 1) & 1
+    inter = int((seg * (va & vb)).sum())
+    union = int((seg * (va | vb)).sum())
+    return inter / union if union > 0 else 0.0
+
+
+def iou_matrix(counts_a: List[np.ndarray], counts_b: List[np.ndarray]) -> np.ndarray:
+    m = np.zeros((len(counts_a), len(counts_b)), np.float64)
+    for i, a in enumerate(counts_a):
+        for j, b in enumerate(counts_b):
+            m[i, j] = iou(a, b)
+    return m
+
+
+"""
+COCO compatible string format (the same as rleToString/rleFrString in pycocotools)
+"""
+
+def to_coco_string(counts: np.ndarray) -> str:
+    s = []
+    cnts = counts.tolist()
+    for i, x in enumerate(cnts):
+        if i > 2: x -= cnts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = (x != -1) if (c & 0x10) else (x != 0)
+            if more: c |= 0x20
+            s.append(chr(c + 48))
+    return ''.join(s)
+
+
+def from_coco_string(s: [str, bytes]) -> np.ndarray:
+    if isinstance(s, str):
+        s = s.encode('ascii')
+    cnts = []
+    p = 0
+    while p < len(s):
+        x, k, more = 0, 0, True
+        while more:
+            c = s[p] - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = bool(c & 0x20)
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << (5 * k)
+        if len(cnts) > 2:
+            x += cnts[-2]
+        cnts.append(x)
+    return np.asarray(cnts, dtype=COUNTS_DTYPE)
+
+
+def to_coco(counts: np.ndarray, h: int, w: int) -> Dict:
+    return {'size': [int(h), int(w)], 'counts': to_coco_string(counts)}
+
+
+def from_coco(rle: Dict) -> np.ndarray:
+    counts = rle['counts']
+    if isinstance(counts, list):
+        return np.asarray(counts, dtype=COUNTS_DTYPE)
+    return from_coco_string(counts)
+
+
+"""
+Mask store
+"""
+
+def _open_meta(path: Path, height=None, width=None) -> Tuple[int, int]:
+    meta_file = path("meta.json")
+    if os.path.isfile(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if height is not None and (meta['height'], meta['width']) != (int(height), int(width)):
+            raise MaskSizeMismatch(f"store {path} is {meta['height']}x{meta['width']}, not {height}x{width}")
+        return meta['height'], meta['width']
+    if height is None:
+        raise MaskStoreError(f'{path} is not a mask store!')
+    with open(meta_file, 'w') as f:
+        json.dump({'height': int(height), 'width': int(width), 'format': 'rle-colmajor-u32'}, f)
+    return int(height), int(width)
+
+
+def _repair_store(path: Path) -> None:
+    """
+    Cut the torn tail left by a crashed writer: the partial index record, the index records pointing past the end of
+    counts.bin, and the counts not covered by any index record. Otherwise the records appended later are misaligned.
+    """
+    index_file, counts_file = path("index.bin"), path("counts.bin")
+    if not os.path.isfile(index_file):
+        return
+    index_size = os.path.getsize(index_file)
+    counts_size = os.path.getsize(counts_file) // COUNTS_DTYPE.itemsize if os.path.isfile(counts_file) else 0
+    n = index_size // INDEX_DTYPE.itemsize
+    end = 0
+    if n > 0:
+        index = np.memmap(index_file, dtype=INDEX_DTYPE, mode='r', shape=(n,))
+        ends = index['offset'] + index['length']
+        # the records are appended in the order of their offsets, the valid ones are a prefix
+        n = int(np.searchsorted(np.maximum.accumulate(ends) > counts_size, True))
+        end = int(ends[n - 1]) if n > 0 else 0
+        del index
+    if index_size != n * INDEX_DTYPE.itemsize:
+        log.warning('index.bin of %s is truncated to %d records.' % (path, n))
+        os.truncate(index_file, n * INDEX_DTYPE.itemsize)
+    if os.path.isfile(counts_file) and os.path.getsize(counts_file) != end * COUNTS_DTYPE.itemsize:
+        log.warning('counts.bin of %s is truncated to %d counts.' % (path, end))
+        os.truncate(counts_file, end * COUNTS_DTYPE.itemsize)
+
+
+class MaskStoreWriter(object):
+    def __init__(self, height, width, path: [str, Path] = None, flush_every=256) -> None:
+        """
+        :param height, width: The size of all masks in this store
+        :param path: The store directory, the default is "masks" in the OutputPath of this run.
+                     An existing store is opened for appending.
+        :param flush_every: Number of index records buffered before being written to index.bin
+        """
+        self._path = (O + "masks" if path is None else Path(str(path))).create()
+        self.height, self.width = _open_meta(self._path, height, width)
+        _repair_store(self._path)
+        self._counts_file = open(self._path("counts.bin"), 'ab')
+        self._index_file = open(self._path("index.bin"), 'ab')
+        self._offset = self._counts_file.tell() // COUNTS_DTYPE.itemsize
+        self._records = np.zeros(int(flush_every), INDEX_DTYPE)
+        self._n_records = 0
+
+    @property
+    def Path(self) -> Path: return self._path
+
+    def write(self, frame: int, obj_ids, masks: np.ndarray) -> np.ndarray:
+        """
+        :param frame: The frame index
+        :param obj_ids: n object ids
+        :param masks: (n, h, w) masks of the objects in this frame
+        :return: The areas of the masks
+        """
+        obj_ids = np.atleast_1d(np.asarray(obj_ids))
+        if masks.ndim == 2: masks = masks[None]
+        if masks.shape[1:] != (self.height, self.width):
+            raise MaskSizeMismatch(f'{masks.shape[1:]} != {(self.height, self.width)}')
+        if masks.shape[0] != obj_ids.shape[0]:
+            raise ValueError(f'{obj_ids.shape[0]} object ids for {masks.shape[0]} masks!')
+        counts, lengths = encode_batch(masks)
+        areas = areas_batch(counts, lengths)
+        counts.tofile(self._counts_file)
+
+        n = len(lengths)
+        offsets = np.zeros(n, np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        offsets += self._offset
+        self._offset += int(counts.shape[0])
+
+        start = 0
+        while start < n:
+            m = min(n - start, len(self._records) - self._n_records)
+            r = self._records[self._n_records: self._n_records + m]
+            r['frame'] = frame
+            r['obj'] = obj_ids[start: start + m]
+            r['length'] = lengths[start: start + m]
+            r['offset'] = offsets[start: start + m]
+            r['area'] = areas[start: start + m]
+            self._n_records += m
+            start += m
+            if self._n_records == len(self._records):
+                self._flush_index()
+        return areas
+
+    def _flush_index(self):
+        # counts must reach the disk before the index records pointing to them
+        self._counts_file.flush()
+        self._records[:self._n_records].tofile(self._index_file)
+        self._index_file.flush()
+        self._n_records = 0
+
+    def flush(self):
+        self._flush_index()
+
+    def close(self):
+        if self._counts_file.closed:
+            return
+        self._flush_index()
+        self._counts_file.close()
+        self._index_file.close()
+
+    def __enter__(self): return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb): self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class MaskStoreReader(object):
+    def __init__(self, path: [str, Path] = None) -> None:
+        self._path = O + "masks" if path is None else Path(str(path))
+        self.height, self.width = _open_meta(self._path)
+        self._counts = self._memmap("counts.bin", COUNTS_DTYPE)
+        self._index = self._memmap("index.bin", INDEX_DTYPE)
+        # records of a (frame, obj) written later shadow the earlier ones
+        keys = (self._index['frame'].astype(np.int64) << 32) | (self._index['obj'].astype(np.int64) & 0xffffffff)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        last = np.ones(keys.shape[0], bool)
+        last[:-1] = keys[1:] != keys[:-1]
+        self._keys, self._order = keys[last], order[last]
+        self._decoder = RLEDecoder(self.height, self.width)
+        log.debug('Mask store %s opened with %d masks.' % (self._path, len(self._keys)))
+
+    def _memmap(self, file_name, dtype):
+        size = os.path.getsize(self._path(file_name)) // dtype.itemsize
+        if size == 0:
+            return np.zeros(0, dtype)
+        return np.memmap(self._path(file_name), dtype=dtype, mode='r', shape=(size,))
+
+    def __len__(self): return len(self._keys)
+
+    @property
+    def Index(self) -> np.ndarray:
+        """ The index records (one per mask) sorted by (frame, object id) """
+        return self._index[self._order]
+
+    def frames(self) -> np.ndarray:
+        return np.unique(self._keys >> 32)
+
+    def _rows(self, frame) -> np.ndarray:
+        lo = np.searchsorted(self._keys, frame << 32, side='left')
+        hi = np.searchsorted(self._keys, (frame + 1) << 32, side='left')
+        return self._order[lo: hi]
+
+    def _row(self, frame, obj) -> int:
+        key = (int(frame) << 32) | (int(obj) & 0xffffffff)
+        i = np.searchsorted(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            raise MaskNotExist(f'frame {frame}, object {obj}')
+        return int(self._order[i])
+
+    def _counts_of_row(self, row) -> np.ndarray:
+        r = self._index[row]
+        return self._counts[r['offset']: r['offset'] + r['length']]
+
+    def objects(self, frame) -> np.ndarray:
+        return self._index['obj'][self._rows(frame)]
+
+    def rle(self, frame, obj) -> np.ndarray:
+        return self._counts_of_row(self._row(frame, obj))
+
+    def area(self, frame, obj) -> int:
+        return int(self._index['area'][self._row(frame, obj)])
+
+    def iou(self, frame, obj, counts: np.ndarray) -> float:
+        return iou(self.rle(frame, obj), counts)
+
+    def coco(self, frame, obj) -> Dict:
+        return to_coco(self.rle(frame, obj), self.height, self.width)
+
+    def read(self, frame, obj, out: np.ndarray = None) -> np.ndarray:
+        return self._decoder.decode(self.rle(frame, obj), out=out)
+
+    def read_frame(self, frame, obj_ids=None, out: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param obj_ids: The objects to decode, all objects of the frame if None
+        :param out: A preallocated (n, h, w) array (n >= number of objects)
+        :return: (obj_ids, masks)
+        """
+        if obj_ids is None:
+            rows = self._rows(frame)
+        else:
+            rows = [self._row(frame, o) for o in np.atleast_1d(obj_ids)]
+        objs = self._index['obj'][rows]
+        masks = self._decoder.decode_batch([self._counts_of_row(r) for r in rows], out=out)
+        return objs, masks
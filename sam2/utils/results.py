@@ -0,0 +1,307 @@
+"""
+Columnar storage of the tracking results (per-frame boxes, scores and object ids).
+
+The results of a run are stored in a directory (default: "results" in the OutputPath), one sub-directory for
+each sequence:
+    - meta.json        column names and dtypes, number of rows covered by the index
+    - <column>.bin     raw values of a column, appended chunk by chunk
+    - index/*.npy      row orders sorted by (object, frame) and by frame, written when the writer is closed
+
+Each column is memory-mapped on its own, so a query (e.g. "object 3, frames 10000-20000") or an evaluation only
+reads the columns it needs. The results could be exported to the common benchmark formats in bulk.
+"""
+
+import os
+import json
+import logging as log
+from collections import OrderedDict
+from typing import Dict, List
+
+import numpy as np
+
+from sam2.configs import O, Path
+
+COLUMNS = OrderedDict([
+    ("frame", np.dtype('<i4')),
+    ("obj", np.dtype('<i4')),
+    ("x", np.dtype('<f4')),
+    ("y", np.dtype('<f4')),
+    ("w", np.dtype('<f4')),
+    ("h", np.dtype('<f4')),
+    ("score", np.dtype('<f4')),
+])
+BOX_COLUMNS = ("x", "y", "w", "h")
+
+
+class ResultsError(Exception): pass
+class SequenceNotExist(ResultsError): pass
+
+
+def _read_meta(path: Path) -> Dict:
+    with open(path("meta.json")) as f:
+        return json.load(f)
+
+
+def _write_meta(path: Path, meta: Dict) -> None:
+    tmp_file = path(f".meta.json.{os.getpid()}.tmp")
+    with open(tmp_file, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_file, path("meta.json"))
+
+
+def _truncate_columns(path: Path) -> None:
+    """ Cut the columns to the same number of rows, the tail of a crashed writer would misalign the appended rows """
+    sizes = {k: os.path.getsize(path(f"{k}.bin")) if os.path.isfile(path(f"{k}.bin")) else 0 for k in COLUMNS}
+    rows = min(sizes[k] // v.itemsize for k, v in COLUMNS.items())
+    for k, v in COLUMNS.items():
+        if sizes[k] != rows * v.itemsize:
+            log.warning('%s.bin of %s is truncated to %d rows.' % (k, path, rows))
+            os.truncate(path(f"{k}.bin"), rows * v.itemsize)
+
+
+class ResultsWriter(object):
+    def __init__(self, sequence: str, root: [str, Path] = None, chunk_size=4096) -> None:
+        """
+        :param sequence: The sequence name, results of an existing sequence are appended
+        :param root: The results directory, the default is "results" in the OutputPath of this run
+        :param chunk_size: Number of rows buffered before being written to the column files
+        """
+        self._path = ((O + "results") if root is None else Path(str(root))).create() + sequence
+        self._path.create()
+        if os.path.isfile(self._path("meta.json")):
+            meta = _read_meta(self._path)
+            if list(meta["columns"].keys()) != list(COLUMNS.keys()):
+                raise ResultsError(f"Columns of {self._path} are {list(meta['columns'])}")
+            _truncate_columns(self._path)
+        _write_meta(self._path, {"columns": {k: v.str for k, v in COLUMNS.items()}, "indexed_rows": 0})
+        self._files = OrderedDict((k, open(self._path(f"{k}.bin"), 'ab')) for k in COLUMNS)
+        self._chunk = OrderedDict((k, np.zeros(int(chunk_size), v)) for k, v in COLUMNS.items())
+        self._n = 0
+
+    @property
+    def Path(self) -> Path: return self._path
+
+    def append(self, frame: int, obj_ids, boxes: np.ndarray, scores=None) -> None:
+        """
+        :param frame: The frame index
+        :param obj_ids: n object ids
+        :param boxes: (n, 4) boxes in (x, y, w, h)
+        :param scores: n scores, optional
+        """
+        obj_ids = np.atleast_1d(np.asarray(obj_ids))
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        n = obj_ids.shape[0]
+        if boxes.shape[0] != n:
+            raise ValueError(f'{n} object ids for {boxes.shape[0]} boxes!')
+        scores = np.ones(n) if scores is None else np.atleast_1d(np.asarray(scores))
+        start = 0
+        while start < n:
+            m = min(n - start, len(self._chunk["frame"]) - self._n)
+            s = slice(self._n, self._n + m)
+            self._chunk["frame"][s] = frame
+            self._chunk["obj"][s] = obj_ids[start: start + m]
+            for i, k in enumerate(BOX_COLUMNS):
+                self._chunk[k][s] = boxes[start: start + m, i]
+            self._chunk["score"][s] = scores[start: start + m]
+            self._n += m
+            start += m
+            if self._n == len(self._chunk["frame"]):
+                self.flush()
+
+    def flush(self) -> None:
+        if self._n == 0:
+            return
+        for k, f in self._files.items():
+            self._chunk[k][:self._n].tofile(f)
+            f.flush()
+        self._n = 0
+
+    def close(self) -> None:
+        if self._files["frame"].closed:
+            return
+        self.flush()
+        for f in self._files.values():
+            f.close()
+        build_index(self._path)
+
+    def __enter__(self): return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb): self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def _load_column(path: Path, name: str) -> np.ndarray:
+    dtype = COLUMNS[name]
+    size = os.path.getsize(path(f"{name}.bin")) // dtype.itemsize
+    if size == 0:
+        return np.zeros(0, dtype)
+    return np.memmap(path(f"{name}.bin"), dtype=dtype, mode='r', shape=(size,))
+
+
+def _sort_index(frames: np.ndarray, objs: np.ndarray) -> Dict[str, np.ndarray]:
+    obj_order = np.lexsort((frames, objs))
+    objects, obj_starts = np.unique(objs[obj_order], return_index=True)
+    frame_order = np.argsort(frames, kind='stable')
+    return {
+        "obj_order": obj_order.astype(np.int64),
+        "obj_frames": frames[obj_order],
+        "objects": objects,
+        "obj_starts": np.append(obj_starts, len(obj_order)).astype(np.int64),
+        "frame_order": frame_order.astype(np.int64),
+        "frames_sorted": frames[frame_order],
+    }
+
+
+def build_index(path: [str, Path]) -> None:
+    """ Build the (object, frame) and frame indexes of a sequence, only the frame and obj columns are read """
+    path = Path(str(path))
+    frames, objs = _load_column(path, "frame"), _load_column(path, "obj")
+    rows = min(len(frames), len(objs))
+    index = _sort_index(np.asarray(frames[:rows]), np.asarray(objs[:rows]))
+    index_dir = (path + "index").create()
+    for k, v in index.items():
+        np.save(index_dir(f"{k}.npy"), v)
+    meta = _read_meta(path)
+    meta["indexed_rows"] = int(rows)
+    _write_meta(path, meta)
+
+
+class ResultsReader(object):
+    def __init__(self, sequence: str, root: [str, Path] = None) -> None:
+        self._path = ((O + "results") if root is None else Path(str(root))) + sequence
+        if not os.path.isfile(self._path("meta.json")):
+            raise SequenceNotExist(str(self._path))
+        self.sequence = sequence
+        self._columns = {}
+        meta = _read_meta(self._path)
+        self.rows = min(os.path.getsize(self._path(f"{k}.bin")) // v.itemsize for k, v in COLUMNS.items())
+        if meta.get("indexed_rows") == self.rows and os.path.isdir(self._path("index")):
+            self._index = {k: np.load(self._path("index", f"{k}.npy"), mmap_mode='r')
+                           for k in ("obj_order", "obj_frames", "objects", "obj_starts", "frame_order", "frames_sorted")}
+        else:
+            # the writer is still running (or crashed), the index is built in memory
+            log.debug('Index of %s is out of date, rebuilt in memory.' % self._path)
+            self._index = _sort_index(np.asarray(self.column("frame")), np.asarray(self.column("obj")))
+
+    def __len__(self): return self.rows
+
+    def column(self, name: str) -> np.ndarray:
+        """ The whole column (memory-mapped), only the required columns are opened """
+        col = self._columns.get(name)
+        if col is None:
+            col = self._columns[name] = _load_column(self._path, name)[:self.rows]
+        return col
+
+    def objects(self) -> np.ndarray:
+        return np.asarray(self._index["objects"])
+
+    def _take(self, rows: np.ndarray, columns) -> Dict[str, np.ndarray]:
+        columns = COLUMNS.keys() if columns is None else columns
+        return OrderedDict((k, self.column(k)[rows]) for k in columns)
+
+    def object_rows(self, obj: int, frame_start=None, frame_end=None) -> np.ndarray:
+        """ :return: Row numbers of an object sorted by frame, in [frame_start, frame_end) """
+        i = np.searchsorted(self._index["objects"], obj)
+        if i == len(self._index["objects"]) or self._index["objects"][i] != obj:
+            return np.zeros(0, np.int64)
+        lo, hi = int(self._index["obj_starts"][i]), int(self._index["obj_starts"][i + 1])
+        frames = self._index["obj_frames"][lo: hi]
+        if frame_start is not None:
+            lo += int(np.searchsorted(frames, frame_start, side='left'))
+        if frame_end is not None:
+            hi = self._index["obj_starts"][i] + int(np.searchsorted(frames, frame_end, side='left'))
+        return np.asarray(self._index["obj_order"][lo: hi])
+
+    def frame_rows(self, frame_start, frame_end=None) -> np.ndarray:
+        """ :return: Row numbers of the frames in [frame_start, frame_end), or of a single frame """
+        frame_end = frame_start + 1 if frame_end is None else frame_end
+        lo = np.searchsorted(self._index["frames_sorted"], frame_start, side='left')
+        hi = np.searchsorted(self._index["frames_sorted"], frame_end, side='left')
+        return np.asarray(self._index["frame_order"][lo: hi])
+
+    def query(self, obj: int, frame_start=None, frame_end=None, columns=None) -> Dict[str, np.ndarray]:
+        """ e.g. query(3, 10000, 20000, columns=("frame", "x", "y", "w", "h")) """
+        return self._take(self.object_rows(obj, frame_start, frame_end), columns)
+
+    def frames(self, frame_start, frame_end=None, columns=None) -> Dict[str, np.ndarray]:
+        return self._take(self.frame_rows(frame_start, frame_end), columns)
+
+    def boxes(self, obj: int, frame_start=None, frame_end=None) -> np.ndarray:
+        """ :return: (n, 4) boxes of an object, sorted by frame """
+        cols = self.query(obj, frame_start, frame_end, columns=BOX_COLUMNS)
+        return np.stack([cols[k] for k in BOX_COLUMNS], axis=1)
+
+    """
+    Export
+    """
+
+    def export_mot(self, file_name: str) -> None:
+        """ MOTChallenge: <frame>,<id>,<x>,<y>,<w>,<h>,<score>,-1,-1,-1 with 1-based frames """
+        cols = self._take(np.asarray(self._index["frame_order"]), None)
+        data = np.empty((self.rows, 10), np.float64)
+        data[:, 0] = cols["frame"] + 1
+        data[:, 1] = cols["obj"]
+        for i, k in enumerate(BOX_COLUMNS + ("score",)):
+            data[:, 2 + i] = cols[k]
+        data[:, 7:] = -1
+        np.savetxt(file_name, data, fmt=['%d', '%d', '%.2f', '%.2f', '%.2f', '%.2f', '%.4f', '%d', '%d', '%d'],
+                   delimiter=',')
+
+    def export_sot(self, obj: int, file_name: str, num_frames=None, delimiter=',') -> None:
+        """
+        Single object tracking (OTB/LaSOT/GOT-10k): one "x,y,w,h" line per frame.
+        If num_frames is given, the frames without a result of the object are filled with 0,0,0,0.
+        """
+        cols = self.query(obj, columns=("frame",) + BOX_COLUMNS)
+        boxes = np.stack([cols[k] for k in BOX_COLUMNS], axis=1)
+        if num_frames is not None:
+            full = np.zeros((int(num_frames), 4), np.float32)
+            valid = cols["frame"] < num_frames
+            full[cols["frame"][valid]] = boxes[valid]
+            boxes = full
+        np.savetxt(file_name, boxes, fmt='%.4f', delimiter=delimiter)
+
+
+class ResultsStore(object):
+    """ All the sequences in a results directory """
+    def __init__(self, root: [str, Path] = None) -> None:
+        self._root = (O + "results") if root is None else Path(str(root))
+
+    def sequences(self) -> List[str]:
+        if not os.path.isdir(str(self._root)):
+            return []
+        with os.scandir(str(self._root)) as it:
+            return sorted(e.name for e in it if e.is_dir() and os.path.isfile(os.path.join(e.path, "meta.json")))
+
+    def writer(self, sequence: str, **kwargs) -> ResultsWriter:
+        return ResultsWriter(sequence, root=self._root, **kwargs)
+
+    def reader(self, sequence: str) -> ResultsReader:
+        return ResultsReader(sequence, root=self._root)
+
+    def export(self, out_dir: [str, Path], fmt="mot", num_frames: Dict[str, int] = None) -> List[str]:
+        """
+        :param fmt: "mot" (one <sequence>.txt per sequence) or "sot" (one <sequence>_<obj>.txt per object)
+        :param num_frames: Number of frames of each sequence, used by "sot" to fill the missing frames
+        :return: The exported files
+        """
+        out_dir = Path(str(out_dir)).create()
+        files = []
+        for seq in self.sequences():
+            reader = self.reader(seq)
+            if fmt == "mot":
+                files.append(out_dir(f"{seq}.txt"))
+                reader.export_mot(files[-1])
+            elif fmt == "sot":
+                n = None if num_frames is None else num_frames.get(seq)
+                for obj in reader.objects():
+                    files.append(out_dir(f"{seq}_{obj}.txt"))
+                    reader.export_sot(int(obj), files[-1], num_frames=n)
+            else:
+                raise ValueError(f"Unknown format <{fmt}>, supported: mot, sot")
+        return files
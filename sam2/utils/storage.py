@@ -146,11 +146,12 @@ class DataBlock(object):
         else:
             self._shared_mem.close()
 
-        self._blocks_dict.pop(self._name)
+        self._blocks_dict.pop(self._name, None)
         self._available = False
 
     def __del__(self):
-        if self._available:
+        # a block failed to attach has no shared memory to close
+        if self._available and hasattr(self, '_shared_mem'):
             self.close()
 
     def __getitem__(self, index):
@@ -291,7 +292,12 @@ class DataBlock(object):
             cls._index %= Length
 
             share_str = SharedList[cls._index]
-            block = cls(name=share_str)
+            try:
+                block = cls(name=share_str)
+            except (FileNotFoundError, ValueError):
+                # the block has been released before we see the message (or it is an empty slot)
+                log.debug('Skip unavailable shared message: %s' % share_str)
+                continue
             cls._blocks_dict[block._name] = block
 
     @classmethod
@@ -305,12 +311,11 @@ class DataBlock(object):
     def check_alive(cls):
         for i in range(3):
             try:
-                for name in cls._blocks_dict.keys():
+                for name in list(cls._blocks_dict.keys()):
                     try:
-                        _o = sm.SharedMemory(name)
+                        sm.SharedMemory(name).close()
                     except FileNotFoundError:
-                        obj = cls._blocks_dict.pop()
-
+                        obj = cls._blocks_dict[name]
                         obj.close()
                 log.debug("Datablock Checking finished!")
                 break